@@ -1,3 +1,4 @@
+import copy
 import json
 
 from django.contrib import admin
@@ -7,12 +8,13 @@ from django.conf import settings
 from django.contrib.admin.utils import unquote
 from django.template.defaultfilters import truncatechars
 from django.template.response import TemplateResponse
-from django.http.response import HttpResponseNotFound
-from django.core.exceptions import PermissionDenied
+from django.http import Http404
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.validators import URLValidator
 from django.utils.html import format_html_join
 from django.utils.text import capfirst
 
-from notifications import models, utils
+from notifications import backends, models, rendering, utils
 
 
 class RandomTokenWidget(AdminTextInputWidget):
@@ -25,7 +27,7 @@ class RandomTokenWidget(AdminTextInputWidget):
 @admin.register(models.Event)
 class EventAdmin(admin.ModelAdmin):
     fieldsets = (
-        (None, {'fields': ('name', 'external_token')}),
+        (None, {'fields': ('name', 'external_token', 'priority', 'coalesce_window')}),
         ('Slack only', {'fields': ('slack_username', 'slack_icon', 'slack_unfurl_links')}),
         ('Mail only', {'fields': ('mail_from', 'mail_reply_to')}),
     )
@@ -66,6 +68,14 @@ class SubscriptionAdminForm(forms.ModelForm):
                     'target', f'{x} is not a valid slack channel/user (or it is private) - {e.response.data["error"]}'
                 )
 
+    def __validate_webhook_target(self):
+        validate = URLValidator(schemes=['http', 'https'])
+        for x in self.cleaned_data.get('target', '').splitlines():
+            try:
+                validate(x.strip())
+            except ValidationError:
+                self.add_error('target', f'{x} is not a valid URL.')
+
     def clean(self):
         if 'target' in self.changed_data:
             _s = self.cleaned_data.get('service')
@@ -73,6 +83,8 @@ class SubscriptionAdminForm(forms.ModelForm):
                 self.__validate_email_target()
             elif _s == models.Subscription.Service.SLACK:
                 self.__validate_slack_target()
+            elif _s == models.Subscription.Service.WEBHOOK:
+                self.__validate_webhook_target()
         return self.cleaned_data
 
 
@@ -98,20 +110,57 @@ class SubscriptionAdmin(admin.ModelAdmin):
         return actions
 
 
+class DeliveryInline(admin.TabularInline):
+    model = models.Delivery
+    fields = ('subscription', 'target')
+    readonly_fields = ('subscription', 'target')
+    extra = 0
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(models.Notification)
 class NotificationAdmin(admin.ModelAdmin):
-    list_display = ('id', 'subscription', 'time', 'status', 'get_target')
+    list_display = ('id', 'subscription', 'time', 'status', 'priority', 'get_target')
     list_filter = (
         'time',
         'subscription',
         'status',
+        'priority',
         'subscription__event',
         'subscription__service',
     )
     list_filter_select_related = {'subscription': ('event',)}
-    readonly_fields = ('time', 'subscription', 'status', 'message', 'target', 'options')
+    readonly_fields = (
+        'time',
+        'subscription',
+        'status',
+        'priority',
+        'get_message',
+        'target',
+        'get_options',
+        'payload',
+        'html_message',
+        'claimed_by',
+        'claimed_until',
+        'attempts',
+        'next_attempt_at',
+        'last_error',
+    )
     list_select_related = ('subscription', 'subscription__event')
     no_global_search = True
+    inlines = [DeliveryInline]
+
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        if request.resolver_match and request.resolver_match.url_name == 'notifications_notification_changelist':
+            # not displayed in the list, no need to load the (possibly large) payloads
+            qs = qs.defer('message', 'options', 'html_message')
+        return qs
 
     def get_urls(self):
         from django.urls import path
@@ -145,7 +194,7 @@ class NotificationAdmin(admin.ModelAdmin):
             'object_id': object_id,
             'original': obj,
             'object': obj,
-            'message': obj.message,
+            'message': obj.message_text,
             'opts': opts,
             'preserved_filters': self.get_preserved_filters(request),
             'has_view_permission': True,
@@ -153,11 +202,14 @@ class NotificationAdmin(admin.ModelAdmin):
         }
         request.current_app = self.admin_site.name
 
+        if obj.subscription is None:
+            raise Http404('subscription deleted')
         if obj.subscription.service == models.Subscription.Service.SLACK:
             # block-builder preview limit is 3000 per full payload
             # TODO: improve this truncation in the future (for multiple blocks / attachments)
             # for now, truncate "text" to 1000..
-            extra_options = obj.slack_options
+            # deep copy as blocks are truncated below and the options might come from the (shared) payload cache
+            extra_options = copy.deepcopy(obj.slack_options)
             message_blocks = extra_options['blocks']
             message_blocks[0]['text']['text'] = truncatechars(message_blocks[0]['text']['text'], 1000)
             message_blocks = json.dumps({'blocks': message_blocks})
@@ -175,10 +227,19 @@ class NotificationAdmin(admin.ModelAdmin):
             )
             return TemplateResponse(request, "admin/notifications/notification/preview_slack.html", context)
         elif obj.subscription.service == models.Subscription.Service.MAIL:
-            context['html_message'] = obj.options_dict.get('html_message')
+            context['html_message'] = obj.html_message
+            template = obj.options_dict.get('template')
+            if template:
+                # not rendered yet (deferred to notification_sender)
+                _, context['message'], context['html_message'] = rendering.render_mail(
+                    template['name'], template['context']
+                )
             return TemplateResponse(request, "admin/notifications/notification/preview_mail.html", context)
+        elif obj.subscription.service == models.Subscription.Service.WEBHOOK:
+            context['payload'] = json.dumps(backends.WebhookBackend.payload(obj), indent=4)
+            return TemplateResponse(request, "admin/notifications/notification/preview_webhook.html", context)
         else:
-            raise HttpResponseNotFound(f'{obj.subscription.service} not supported')
+            raise Http404(f'{obj.subscription.service} not supported')
 
     def get_target(self, obj):
         targets = [obj.target]
@@ -193,6 +254,16 @@ class NotificationAdmin(admin.ModelAdmin):
     get_target.short_description = 'Target'
     get_target.admin_order_field = 'target'
 
+    def get_message(self, obj):
+        return obj.message_text
+
+    get_message.short_description = 'Message'
+
+    def get_options(self, obj):
+        return json.dumps(obj.options_dict)
+
+    get_options.short_description = 'Options'
+
     def has_add_permission(self, request):
         return False
 
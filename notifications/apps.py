@@ -7,6 +7,38 @@ APP_SETTINGS = dict(
     MAIL_FROM=None,
     SLACK_APP_TOKEN=None,
     SLACK_TEAM=None,
+    SLACK_API_URL='https://slack.com/api/',
+    SLACK_CONCURRENCY=1,
+    # (calls per second, burst) for each scope
+    SLACK_RATE_LIMITS={'method': (10, 20), 'channel': (1, 3)},
+    # delivery backend per Subscription.Service, merged with the built-in ones (see backends.py)
+    BACKENDS={},
+    WEBHOOK_CONCURRENCY=8,
+    WEBHOOK_MAX_PER_HOST=4,
+    WEBHOOK_TIMEOUT=10,
+    BULK_BATCH_SIZE=500,
+    SENDER_LEASE=300,
+    SENDER_BATCH_SIZE=100,
+    SENDER_FLUSH_INTERVAL=5,
+    # maximum share of each batch for lower priority notifications (models.Priority names), the rest is reserved
+    SENDER_LANE_SHARE={'low': 0.5},
+    # per service (Subscription.Service value) overrides can be added next to 'default'
+    RETRY_POLICIES={'default': {'max_attempts': 5, 'backoff': 60, 'max_backoff': 3600}},
+    MAIL_CONNECTION_MAX_MESSAGES=100,
+    MAIL_CONNECTION_IDLE=30,
+    SENDER_WAKEUP=None,
+    SENDER_POLL_MIN=1,
+    SENDER_POLL_MAX=10,
+    # days to keep notifications per status (None keeps forever), per event (or 'default' for all others)
+    RETENTION={'default': {'sent': 90, 'error': 180, 'dead': 180}},
+    CACHE=None,
+    CACHE_TIMEOUT=0,
+    PAYLOAD_CACHE_SIZE=256,
+    API_BATCH_MAX_SIZE=1000,
+    DEFER_TEMPLATES=False,
+    TEMPLATE_RENDER_CACHE_SIZE=128,
+    DEDUP_TTL=3600,
+    DEDUP_CACHE='default',
 )
 
 
@@ -19,3 +51,6 @@ class NotificationsConfig(AppConfig):
             _k = 'NOTIFICATIONS_%s' % k
             if not hasattr(settings, _k):
                 setattr(settings, _k, v)
+
+        # connect cache invalidation and sender wakeup signals
+        from notifications import cache, wakeup  # noqa: F401
@@ -0,0 +1,313 @@
+"""
+delivery backends used by notification_sender, one per Subscription.Service (mail, Slack and webhooks built in).
+
+NOTIFICATIONS_BACKENDS maps services to their backend (dotted path in `BACKEND`) and, optionally, its `BATCH_SIZE`
+(notifications per send_batch() call), `CONCURRENCY` (sends at a time), `RATE_LIMITS` (see ratelimit.py) and
+`OPTIONS` (any other backend arguments). It is merged with the built-in backends, `None` removes one.
+
+notification_sender claims notifications of every service together, then hands each backend its own (in
+registry order) and takes care of their status, retries and rate limits.
+"""
+
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.utils.module_loading import import_string
+from slack_sdk import WebClient, errors
+
+from notifications import coalesce, rendering
+from notifications.httppool import ConnectionPool, HTTPError
+from notifications.models import Subscription
+from notifications.ratelimit import TokenBucketScheduler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKENDS = {
+    Subscription.Service.MAIL: {'BACKEND': 'notifications.backends.MailBackend'},
+    Subscription.Service.SLACK: {'BACKEND': 'notifications.backends.SlackBackend'},
+    Subscription.Service.WEBHOOK: {'BACKEND': 'notifications.backends.WebhookBackend'},
+}
+
+
+class RateLimited(Exception):
+    """
+    raised by backends when the service asks to wait `retry_after` seconds: the notification is kept pending (and
+    its last rate limit key blocked) until then
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f'rate limited, retry after {retry_after} secs')
+        self.retry_after = retry_after
+
+
+class Backend:
+    """
+    base backend, subclasses implement send() or, for services with bulk APIs, send_batch()
+    """
+
+    # notifications per send_batch() call, None for all the ones of a batch
+    batch_size = None
+    # send() calls running at a time (threads) in the default send_batch()
+    concurrency = 1
+    # {scope: (calls per second, burst)} for the scopes of rate_keys()
+    rate_limits = {}
+
+    def __init__(self, batch_size=None, concurrency=None, rate_limits=None):
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if concurrency is not None:
+            self.concurrency = concurrency
+        if rate_limits is not None:
+            self.rate_limits = rate_limits
+        self.limiter = TokenBucketScheduler(self.rate_limits)
+
+    def rate_keys(self, notification):
+        """
+        rate limit keys (scope, value) of a notification, its last one is blocked when the service rate limits it
+        """
+        return ()
+
+    def send(self, notification):
+        """
+        deliver a single notification, raising on errors (RateLimited, transient ones are retried, see retry.py)
+        """
+        raise NotImplementedError('abstract method')
+
+    def _send(self, notification):
+        try:
+            self.send(notification)
+        except Exception as e:
+            return e
+        return None
+
+    def send_batch(self, notifications):
+        """
+        deliver `notifications`, returning the result of each: None if sent or the exception it failed with.
+        safe to be called from a single thread only, send() is called from up to `concurrency` threads
+        """
+        if self.concurrency > 1 and len(notifications) > 1:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                return list(pool.map(self._send, notifications))
+        return [self._send(notification) for notification in notifications]
+
+    def end_batch(self):
+        """
+        called after each batch of notification_sender (even if it had nothing for this backend)
+        """
+
+    def close(self):
+        """
+        called when notification_sender stops
+        """
+
+
+class SlackBackend(Backend):
+    """
+    chat.postMessage, paced per API method and per channel.
+    concurrency and rate limits default to NOTIFICATIONS_SLACK_CONCURRENCY and NOTIFICATIONS_SLACK_RATE_LIMITS
+    """
+
+    def __init__(self, concurrency=None, rate_limits=None, **kwargs):
+        super().__init__(
+            concurrency=settings.NOTIFICATIONS_SLACK_CONCURRENCY if concurrency is None else concurrency,
+            rate_limits=settings.NOTIFICATIONS_SLACK_RATE_LIMITS if rate_limits is None else rate_limits,
+            **kwargs,
+        )
+        self.client = WebClient(settings.NOTIFICATIONS_SLACK_APP_TOKEN, base_url=settings.NOTIFICATIONS_SLACK_API_URL)
+
+    def rate_keys(self, notification):
+        return ('method', 'chat.postMessage'), ('channel', notification.target)
+
+    def send(self, notification):
+        try:
+            self.client.chat_postMessage(
+                # text still required for message preview (in notifications)
+                text=notification.message_text,
+                channel=notification.target,
+                **notification.slack_options,
+            )
+        except errors.SlackApiError as e:
+            if e.response.get('error') != 'ratelimited':
+                raise
+            try:
+                retry_after = int(e.response.headers.get('retry-after')) + 5
+            except (ValueError, TypeError):
+                # if no header (weird), wait 15s
+                retry_after = 15
+            raise RateLimited(retry_after) from e
+
+
+class MailBackend(Backend):
+    """
+    one email per notification, over a mail connection reused across notifications (and batches).
+    A new one is opened after NOTIFICATIONS_MAIL_CONNECTION_MAX_MESSAGES emails or NOTIFICATIONS_MAIL_CONNECTION_IDLE
+    seconds without use. Emails are sent one at a time so each one is recorded as sent straight away.
+    """
+
+    batch_size = 1
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.__connection = None
+        self.__connection_sent = 0
+        self.__connection_used = 0
+
+    def __get_connection(self):
+        now = time.monotonic()
+        if self.__connection is not None and (
+            self.__connection_sent >= settings.NOTIFICATIONS_MAIL_CONNECTION_MAX_MESSAGES
+            or now - self.__connection_used > settings.NOTIFICATIONS_MAIL_CONNECTION_IDLE
+        ):
+            self.close()
+        if self.__connection is None:
+            self.__connection = get_connection()
+            self.__connection.open()
+            self.__connection_sent = 0
+        self.__connection_used = now
+        return self.__connection
+
+    def end_batch(self):
+        if time.monotonic() - self.__connection_used > settings.NOTIFICATIONS_MAIL_CONNECTION_IDLE:
+            self.close()
+
+    def close(self):
+        if self.__connection is None:
+            return
+        try:
+            self.__connection.close()
+        except Exception:
+            # broken connection, nothing else to do with it
+            logger.debug('error closing mail connection', exc_info=True)
+        logger.info('mail connection closed after %d emails', self.__connection_sent)
+        self.__connection = None
+
+    @staticmethod
+    def mail_parts(notification, to):
+        """
+        (subject, body, html_message) of a mail notification, rendering its template if notify() deferred it
+        """
+        email_args = notification.options_dict
+        if not email_args.get('template'):
+            return email_args.get('subject'), notification.message_text, notification.html_message
+        template = email_args['template']
+        return rendering.render_mail(
+            template['name'],
+            template['context'],
+            from_email=email_args.get('from_email'),
+            to=to,
+            create_link=template.get('create_link', False),
+        )
+
+    def send(self, notification):
+        """
+        Notifications merged by notification_sender (coalesce.group) are sent as a single email with all their bodies.
+        """
+        email_args = notification.options_dict
+        to = json.loads(notification.target)
+        members = coalesce.members(notification)
+        parts = [self.mail_parts(member, to) for member in members]
+        subject, body, html_message = coalesce.merge_mail(parts) if len(parts) > 1 else parts[0]
+        msg = EmailMultiAlternatives(
+            subject=subject,
+            body=body,
+            from_email=email_args.get('from_email'),
+            to=to,
+            reply_to=email_args.get('reply_to'),
+        )
+        attachments = [attach for member in members for attach in member.options_dict.get("attachments") or []]
+        if attachments:
+            MEDIA_ROOT = Path(settings.MEDIA_ROOT).resolve()
+            for attach in attachments:
+                path = Path(attach[1]).resolve()
+                try:
+                    # check if path is relative to MEDIA_ROOT
+                    path.relative_to(MEDIA_ROOT)
+                except ValueError:
+                    logger.error('invalid path for attachment: %s', path)
+                    continue
+
+                if path.exists() and not path.is_dir():
+                    with path.open() as attachment:
+                        msg.attach(attach[0], attachment.read(), attach[2])
+                else:
+                    logger.error('could not open file from path: %s', path)
+        if html_message:
+            msg.attach_alternative(html_message, 'text/html')
+        msg.connection = self.__get_connection()
+        try:
+            msg.send()
+        except Exception:
+            # reconnect on next email, connection might be the problem
+            self.close()
+            raise
+        self.__connection_sent += 1
+
+
+class WebhookBackend(Backend):
+    """
+    JSON POST of {"event", "text", "subject"?, "blocks"?} to each target URL (a list of those in "notifications" for
+    merged ones), over keep-alive connections pooled per host (see httppool.py).
+    concurrency defaults to NOTIFICATIONS_WEBHOOK_CONCURRENCY, `max_per_host` (requests to the same host at a time)
+    and `timeout` (seconds) to NOTIFICATIONS_WEBHOOK_MAX_PER_HOST and NOTIFICATIONS_WEBHOOK_TIMEOUT.
+    429 and 503 responses with a Retry-After are rate limits (of the host).
+    """
+
+    def __init__(self, concurrency=None, max_per_host=None, timeout=None, headers=None, **kwargs):
+        super().__init__(
+            concurrency=settings.NOTIFICATIONS_WEBHOOK_CONCURRENCY if concurrency is None else concurrency, **kwargs
+        )
+        self.pool = ConnectionPool(
+            max_per_host=settings.NOTIFICATIONS_WEBHOOK_MAX_PER_HOST if max_per_host is None else max_per_host,
+            timeout=settings.NOTIFICATIONS_WEBHOOK_TIMEOUT if timeout is None else timeout,
+        )
+        self.headers = {'Content-Type': 'application/json', **(headers or {})}
+
+    def rate_keys(self, notification):
+        return (('host', urlsplit(notification.target).netloc),)
+
+    @staticmethod
+    def payload(notification):
+        return {
+            'event': notification.subscription.event_id,
+            'text': notification.message_text,
+            **notification.options_dict,
+        }
+
+    def send(self, notification):
+        members = coalesce.members(notification)
+        if len(members) == 1:
+            data = self.payload(notification)
+        else:
+            data = {'event': notification.subscription.event_id, 'notifications': [self.payload(m) for m in members]}
+        try:
+            self.pool.request('POST', notification.target, body=json.dumps(data).encode(), headers=self.headers)
+        except HTTPError as e:
+            if e.status in (429, 503) and e.headers.get('retry-after', '').isdigit():
+                raise RateLimited(int(e.headers['retry-after'])) from e
+            raise
+
+    def close(self):
+        self.pool.close()
+
+
+def get_backends():
+    """
+    backend instances per service, DEFAULT_BACKENDS updated with NOTIFICATIONS_BACKENDS
+    """
+    backends = {}
+    for service, config in {**DEFAULT_BACKENDS, **settings.NOTIFICATIONS_BACKENDS}.items():
+        if config is None:
+            continue
+        backends[service] = import_string(config['BACKEND'])(
+            batch_size=config.get('BATCH_SIZE'),
+            concurrency=config.get('CONCURRENCY'),
+            rate_limits=config.get('RATE_LIMITS'),
+            **config.get('OPTIONS', {}),
+        )
+    return backends
@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 from typing import List, Optional
-from templated_email import get_templated_mail
+
+from notifications import rendering
 
 
 class Block:
@@ -10,6 +11,12 @@ class Block:
     def render_mail(self, **_):
         raise NotImplementedError('abstract method')
 
+    def render_webhook(self, **kw):
+        """
+        (text, options) of the JSON posted to webhooks: the Slack rendering (text and Block Kit blocks) by default
+        """
+        return self.render_slack(**kw)
+
 
 class Empty(Block):
     def render_slack(self, **_):
@@ -39,6 +46,9 @@ class Message(Block, list[Block]):
     def render_mail(self, **_):
         return self._render('render_mail', **_)
 
+    def render_webhook(self, **_):
+        return self._render('render_webhook', **_)
+
 
 @dataclass
 class Basic(Block):
@@ -101,6 +111,9 @@ class BasicSubject(Basic):
         o['subject'] = self.subject
         return m, o
 
+    def render_webhook(self, **_):
+        return self.message, {'subject': self.subject}
+
 
 @dataclass
 class TemplatedMail(Basic):
@@ -111,23 +124,24 @@ class TemplatedMail(Basic):
     template: str
     context: Optional[dict] = None
     create_link: Optional[bool] = False
+    # render in notification_sender (defaults to NOTIFICATIONS_DEFER_TEMPLATES)
+    defer: Optional[bool] = None
 
     def render_mail(self, **kw):
-        _, o = super().render_mail(**kw)
-        template_message = get_templated_mail(
-            template_name=self.template,
-            context=self.context,
+        m, o = super().render_mail(**kw)
+        if rendering.defer_template(self.defer, self.context):
+            o.update(rendering.template_options(self.template, self.context, self.create_link))
+            return m, o
+        o['subject'], body, html_message = rendering.render_mail(
+            self.template,
+            self.context,
             from_email=kw.get('from_email'),
-            create_link=self.create_link,
             to=kw.get('recipient_list'),
+            create_link=self.create_link,
         )
-        o['subject'] = template_message.subject
-        for alt in template_message.alternatives:
-            if alt[1] == 'text/html':
-                o['html_message'] = alt[0]
-                break
-
-        return template_message.body, o
+        if html_message is not None:
+            o['html_message'] = html_message
+        return body, o
 
 
 @dataclass
@@ -0,0 +1,165 @@
+"""
+cache of event configuration (and its enabled subscriptions) so that notify() does not need to read them every time.
+
+entries are kept in memory for NOTIFICATIONS_CACHE_TIMEOUT seconds (0, the default, disables the cache).
+if NOTIFICATIONS_CACHE is set to one of the CACHES aliases, that cache is used instead so that all processes
+share (and invalidate) the same entries.
+
+entries are invalidated whenever an Event or Subscription is saved or deleted (in this process, or any sharing the
+NOTIFICATIONS_CACHE). keep in mind that queryset.update() does not send any signals so entries will only expire after
+the timeout, notify() leaves out the subscriptions deleted meanwhile.
+
+notification payloads are also kept in memory, the NOTIFICATIONS_PAYLOAD_CACHE_SIZE most recently used ones.
+payloads never change (they are addressed by their content) so those entries are never invalidated.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from notifications.models import Event, Payload, Subscription
+
+_local = {}
+_local_lock = threading.Lock()
+_payloads = OrderedDict()
+_payloads_lock = threading.Lock()
+
+
+def _key(event_name):
+    return f'notifications:event:{event_name}'
+
+
+def get_event(event_name):
+    """
+    return event `event_name` and a tuple of its enabled subscriptions
+    raises Event.DoesNotExist if there is no such event
+    """
+    timeout = settings.NOTIFICATIONS_CACHE_TIMEOUT
+    if not timeout:
+        return _load(event_name)
+
+    key = _key(event_name)
+    if settings.NOTIFICATIONS_CACHE:
+        entry = caches[settings.NOTIFICATIONS_CACHE].get(key)
+        if entry is None:
+            entry = _load(event_name)
+            caches[settings.NOTIFICATIONS_CACHE].set(key, entry, timeout)
+        return entry
+
+    now = time.monotonic()
+    entry = _local.get(key)
+    if entry is None or entry[0] < now:
+        entry = (now + timeout, _load(event_name))
+        with _local_lock:
+            _local[key] = entry
+    return entry[1]
+
+
+async def aget_event(event_name):
+    """
+    async version of get_event(), cache hits do not touch the database (nor leave the event loop)
+    """
+    timeout = settings.NOTIFICATIONS_CACHE_TIMEOUT
+    if not timeout:
+        return await _aload(event_name)
+
+    key = _key(event_name)
+    if settings.NOTIFICATIONS_CACHE:
+        entry = await caches[settings.NOTIFICATIONS_CACHE].aget(key)
+        if entry is None:
+            entry = await _aload(event_name)
+            await caches[settings.NOTIFICATIONS_CACHE].aset(key, entry, timeout)
+        return entry
+
+    now = time.monotonic()
+    entry = _local.get(key)
+    if entry is None or entry[0] < now:
+        entry = (now + timeout, await _aload(event_name))
+        with _local_lock:
+            _local[key] = entry
+    return entry[1]
+
+
+def _load(event_name):
+    # single query for event and subscriptions
+    subscriptions = tuple(Subscription.objects.filter(event__name=event_name, enabled=True).select_related('event'))
+    if subscriptions:
+        return subscriptions[0].event, subscriptions
+    # no (enabled) subscriptions, still need to check that the event exists
+    return Event.objects.get(name=event_name), subscriptions
+
+
+async def _aload(event_name):
+    subscriptions = tuple(
+        [s async for s in Subscription.objects.filter(event__name=event_name, enabled=True).select_related('event')]
+    )
+    if subscriptions:
+        return subscriptions[0].event, subscriptions
+    return await Event.objects.aget(name=event_name), subscriptions
+
+
+def get_payloads(hashes):
+    """
+    return {hash: payload} for all `hashes`, loading the ones not cached in a single query
+    """
+    size = settings.NOTIFICATIONS_PAYLOAD_CACHE_SIZE
+    found = {}
+    with _payloads_lock:
+        for h in hashes:
+            if h in _payloads:
+                _payloads.move_to_end(h)
+                found[h] = _payloads[h]
+    missing = set(hashes) - found.keys()
+    loaded = Payload.objects.in_bulk(missing) if missing else {}
+    found.update(loaded)
+    with _payloads_lock:
+        if size:
+            _payloads.update(loaded)
+        while len(_payloads) > size:
+            _payloads.popitem(last=False)
+    return found
+
+
+def get_payload(payload_hash):
+    """
+    raises Payload.DoesNotExist if there is no such payload
+    """
+    try:
+        return get_payloads([payload_hash])[payload_hash]
+    except KeyError:
+        raise Payload.DoesNotExist(payload_hash)
+
+
+def invalidate(event_name):
+    key = _key(event_name)
+    with _local_lock:
+        _local.pop(key, None)
+    if settings.NOTIFICATIONS_CACHE:
+        caches[settings.NOTIFICATIONS_CACHE].delete(key)
+
+
+@receiver(post_save, sender=Event)
+@receiver(post_delete, sender=Event)
+def _event_changed(sender, instance, **kwargs):
+    invalidate(instance.pk)
+
+
+@receiver(pre_save, sender=Subscription)
+def _subscription_moved(sender, instance, raw=False, **kwargs):
+    # subscription might be moving to another event, invalidate the previous one as well
+    if instance.pk and not raw:
+        old_event = Subscription.objects.filter(pk=instance.pk).values_list('event_id', flat=True).first()
+        if old_event is not None and old_event != instance.event_id:
+            invalidate(old_event)
+
+
+@receiver(post_save, sender=Subscription)
+@receiver(post_delete, sender=Subscription)
+def _subscription_changed(sender, instance, **kwargs):
+    if instance.event_id is not None:
+        invalidate(instance.event_id)
@@ -0,0 +1,116 @@
+"""
+notification coalescing (digests) of events with a `coalesce_window`.
+
+notify() holds their notifications until the end of the current window (windows are aligned to the clock, so every
+process agrees on them without sharing any state) and notification_sender merges the ones it claims together for the
+same subscription and target into a single delivery: one Slack message with all their blocks, one email with all
+their bodies.
+"""
+
+import datetime
+import math
+
+from django.utils import timezone
+from django.utils.html import escape
+
+from notifications.models import Subscription
+
+# Slack rejects messages with more blocks than this
+SLACK_MAX_BLOCKS = 50
+SLACK_DIVIDER = {'type': 'divider'}
+MAIL_SEPARATOR = '\n\n' + '-' * 40 + '\n\n'
+HTML_SEPARATOR = '<hr>'
+
+
+def window_end(event, now=None):
+    """
+    time notifications of `event` created `now` are held until, None if the event does not coalesce
+    """
+    if not event.coalesce_window:
+        return None
+    now = now or timezone.now()
+    end = math.ceil(now.timestamp() / event.coalesce_window) * event.coalesce_window
+    return datetime.datetime.fromtimestamp(end, tz=datetime.timezone.utc)
+
+
+def schedule(event, notifications, now=None):
+    """
+    hold (unsaved) `notifications` of `event` until the end of its coalescing window, if it has one
+    """
+    end = window_end(event, now)
+    if end is not None:
+        for notification in notifications:
+            notification.next_attempt_at = end
+    return notifications
+
+
+def _slack_blocks(notification):
+    return len(notification.slack_options['blocks'])
+
+
+def group(notifications):
+    """
+    split `notifications` (with their subscription and event loaded) in lists to be delivered together, in order:
+    notifications of coalescing events for the same subscription and target end up in the same list (as long as
+    Slack messages stay under SLACK_MAX_BLOCKS), any other is on its own
+    """
+    groups = []
+    open_groups = {}
+    for notification in notifications:
+        subscription = notification.subscription
+        if subscription is None or subscription.event is None or not subscription.event.coalesce_window:
+            groups.append([notification])
+            continue
+        key = (subscription.pk, notification.target)
+        current = open_groups.get(key)
+        if current is not None and subscription.service == Subscription.Service.SLACK:
+            blocks = sum(_slack_blocks(n) for n in current) + len(current) + _slack_blocks(notification)
+            if blocks > SLACK_MAX_BLOCKS:
+                current = None
+        if current is None:
+            current = open_groups[key] = []
+            groups.append(current)
+        current.append(notification)
+    return groups
+
+
+def members(notification):
+    """
+    notifications delivered by `notification`: itself or, if it was merged from a group, all of them
+    """
+    return getattr(notification, 'coalesced', None) or [notification]
+
+
+def merge_slack(notifications):
+    """
+    (text, options) of a single Slack message for all of `notifications`: their blocks one after the other,
+    separated by dividers, and the rest of the options of the first one
+    """
+    options = dict(notifications[0].slack_options)
+    options['blocks'] = []
+    attachments = []
+    for notification in notifications:
+        if options['blocks']:
+            options['blocks'].append(SLACK_DIVIDER)
+        options['blocks'].extend(notification.slack_options['blocks'])
+        attachments.extend(notification.slack_options.get('attachments') or [])
+    if attachments:
+        options['attachments'] = attachments
+    return '\n'.join(n.message_text for n in notifications), options
+
+
+def merge_mail(parts):
+    """
+    (subject, body, html_message) of a single email for all of `parts` (subject, body, html_message)
+    """
+    subjects = [subject for subject, _, _ in parts if subject]
+    subject = subjects[0] if subjects else None
+    if subject and len(parts) > 1:
+        subject = f'{subject} (+{len(parts) - 1})'
+    body = MAIL_SEPARATOR.join(body or '' for _, body, _ in parts)
+    html_message = None
+    if any(html for _, _, html in parts):
+        html_message = HTML_SEPARATOR.join(
+            html if html else f'<pre>{escape(body or "")}</pre>' for _, body, html in parts
+        )
+    return subject, body, html_message
@@ -0,0 +1,63 @@
+"""
+duplicate suppression of notify() calls with a `dedup_key` (such as producers retrying after a timeout).
+
+the first call with a key (per event) adds it to the NOTIFICATIONS_DEDUP_CACHE cache, for NOTIFICATIONS_DEDUP_TTL
+seconds, any other call with the same key until then notifies no one. cache.add() is atomic in the shared cache
+backends (database, memcached, redis), the default local memory cache only covers its own process.
+keys of calls that fail (raise) are removed so those can be retried.
+"""
+
+import contextlib
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+def _key(event_name, dedup_key):
+    # hashed: any length or characters, whatever the cache backend
+    digest = hashlib.sha256(f'{event_name}\n{dedup_key}'.encode()).hexdigest()
+    return f'notifications:dedup:{digest}'
+
+
+def _ttl(ttl):
+    return settings.NOTIFICATIONS_DEDUP_TTL if ttl is None else ttl
+
+
+def claim(event_name, dedup_key, ttl=None):
+    """
+    whether this is the first call with `dedup_key` for `event_name` (within `ttl` seconds, NOTIFICATIONS_DEDUP_TTL
+    by default), recording it if so
+    """
+    return caches[settings.NOTIFICATIONS_DEDUP_CACHE].add(_key(event_name, dedup_key), 1, _ttl(ttl))
+
+
+def release(event_name, dedup_key):
+    caches[settings.NOTIFICATIONS_DEDUP_CACHE].delete(_key(event_name, dedup_key))
+
+
+async def aclaim(event_name, dedup_key, ttl=None):
+    return await caches[settings.NOTIFICATIONS_DEDUP_CACHE].aadd(_key(event_name, dedup_key), 1, _ttl(ttl))
+
+
+async def arelease(event_name, dedup_key):
+    await caches[settings.NOTIFICATIONS_DEDUP_CACHE].adelete(_key(event_name, dedup_key))
+
+
+@contextlib.contextmanager
+def once(event_name, dedup_key, ttl=None):
+    """
+    yields whether the block should run (see claim), always True without a `dedup_key`.
+    the key is released if the block raises
+    """
+    if dedup_key is None:
+        yield True
+        return
+    if not claim(event_name, dedup_key, ttl):
+        yield False
+        return
+    try:
+        yield True
+    except BaseException:
+        release(event_name, dedup_key)
+        raise
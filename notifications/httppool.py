@@ -0,0 +1,103 @@
+"""
+minimal keep-alive HTTP client (standard library only) for webhook deliveries.
+
+connections are pooled per host (scheme, host and port) and reused across requests, up to `max_per_host` requests
+run against the same host at a time (any other waits for one of those to finish), so a slow consumer cannot take all
+the sender threads.
+"""
+
+import http.client
+import threading
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+
+class HTTPError(Exception):
+    """
+    non-2xx response
+    """
+
+    def __init__(self, status, headers=None, body=b''):
+        super().__init__(f'HTTP {status}')
+        self.status = status
+        # lowercase names
+        self.headers = {k.lower(): v for k, v in (headers or {}).items()}
+        self.body = body
+
+
+class ConnectionPool:
+    def __init__(self, max_per_host=4, timeout=10):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self._idle = defaultdict(list)
+        self._slots = {}
+        self._lock = threading.Lock()
+        # connections opened (not reused), for stats and tests
+        self.opened = 0
+
+    @staticmethod
+    def _host(url):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f'invalid URL: {url}')
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        path = parts.path or '/'
+        if parts.query:
+            path = f'{path}?{parts.query}'
+        return (parts.scheme, parts.hostname, port), path
+
+    def _slot(self, host):
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._slots[host]
+
+    def _get(self, host):
+        with self._lock:
+            if self._idle[host]:
+                return self._idle[host].pop(), True
+            self.opened += 1
+        scheme, hostname, port = host
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return cls(hostname, port, timeout=self.timeout), False
+
+    def _put(self, host, conn):
+        with self._lock:
+            self._idle[host].append(conn)
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        returns (status, headers, body) of a 2xx response, raises HTTPError for any other (or OSError)
+        """
+        host, path = self._host(url)
+        with self._slot(host):
+            while True:
+                conn, reused = self._get(host)
+                try:
+                    conn.request(method, path, body=body, headers=headers or {})
+                    response = conn.getresponse()
+                    data = response.read()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    conn.close()
+                    if reused:
+                        # idle connection closed by the server meanwhile, try again with another one
+                        continue
+                    raise
+                except BaseException:
+                    conn.close()
+                    raise
+                break
+            if response.will_close:
+                conn.close()
+            else:
+                self._put(host, conn)
+        if not 200 <= response.status < 300:
+            raise HTTPError(response.status, dict(response.getheaders()), data)
+        return response.status, dict(response.getheaders()), data
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, defaultdict(list)
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
@@ -0,0 +1,147 @@
+import datetime
+import gzip
+import json
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils import timezone
+
+from notifications.models import Notification, Payload
+
+# statuses that can be pruned (pending ones never are), as used in NOTIFICATIONS_RETENTION
+STATUSES = {
+    'sent': Notification.STATUS_SENT,
+    'error': Notification.STATUS_ERROR,
+    'dead': Notification.STATUS_DEAD,
+}
+# unused payloads are kept for a while, notify() might be about to reuse them
+PAYLOAD_GRACE = datetime.timedelta(days=1)
+ARCHIVE_FIELDS = (
+    'id',
+    'time',
+    'subscription_id',
+    'subscription__event_id',
+    'subscription__service',
+    'status',
+    'target',
+    'message',
+    'options',
+    'payload_id',
+    'payload__message',
+    'payload__options',
+    'html_message',
+    'attempts',
+    'last_error',
+)
+
+
+class Command(BaseCommand):
+    help = 'Delete old notifications, according to NOTIFICATIONS_RETENTION'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only count what would be deleted')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Notifications deleted per transaction')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to wait between chunks')
+        parser.add_argument(
+            '--archive', type=Path, help='Directory to save deleted notifications to (as gzipped JSON lines)'
+        )
+
+    def handle(self, *args, **options):
+        if options['archive'] and not options['archive'].is_dir():
+            raise CommandError(f'{options["archive"]} is not a directory')
+
+        self.archive = None
+        try:
+            total = 0
+            for status, event, days, qs in self.get_rules():
+                if options['dry_run']:
+                    count = qs.count()
+                else:
+                    count = self.prune(qs, options)
+                total += count
+                self.stdout.write(f'{event or "*"} / {status} older than {days} days: {count}')
+            qs = Payload.objects.filter(notification__isnull=True, last_used__lt=timezone.now() - PAYLOAD_GRACE)
+            if options['dry_run']:
+                count = qs.count()
+            else:
+                count = self.prune_payloads(qs, options)
+            self.stdout.write(f'unused payloads: {count}')
+        finally:
+            if self.archive:
+                self.archive.close()
+        self.stdout.write(f'{total} notifications {"to delete" if options["dry_run"] else "deleted"}')
+
+    def get_rules(self):
+        """
+        yield (status, event, days, queryset) for each retention rule.
+        `default` applies to notifications of any event without its own rule for that status
+        """
+        retention = settings.NOTIFICATIONS_RETENTION
+        now = timezone.now()
+        for status, value in STATUSES.items():
+            overrides = [ev for ev, rules in retention.items() if ev != 'default' and status in rules]
+            for event in [None] + overrides:
+                days = retention.get(event or 'default', {}).get(status)
+                if days is None:
+                    # keep forever
+                    continue
+                qs = Notification.objects.filter(status=value, time__lt=now - datetime.timedelta(days=days))
+                if event is None:
+                    qs = qs.exclude(subscription__event__in=overrides)
+                else:
+                    qs = qs.filter(subscription__event=event)
+                yield status, event, days, qs
+
+    def prune(self, qs, options):
+        """
+        delete notifications in `qs`, oldest (first created) first, in chunks so no lock is held for long.
+        chunks walk the primary key index from the last one deleted, no sorting nor rescanning of the rows kept
+        """
+        count = 0
+        last_pk = 0
+        while True:
+            with transaction.atomic():
+                pks = list(
+                    qs.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[: options['chunk_size']]
+                )
+                if not pks:
+                    break
+                last_pk = pks[-1]
+                if options['archive']:
+                    self.save_archive(options['archive'], pks)
+                Notification.objects.filter(pk__in=pks).delete()
+            count += len(pks)
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        return count
+
+    def prune_payloads(self, qs, options):
+        """
+        delete payloads in `qs` (no longer used by any notification), in chunks
+        """
+        count = 0
+        while True:
+            with transaction.atomic():
+                pks = list(qs.values_list('pk', flat=True)[: options['chunk_size']])
+                if not pks:
+                    break
+                Payload.objects.filter(pk__in=pks, notification__isnull=True).delete()
+            count += len(pks)
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        return count
+
+    def save_archive(self, directory, pks):
+        if self.archive is None:
+            path = directory / f'notifications-{timezone.now():%Y%m%d%H%M%S}.jsonl.gz'
+            self.archive = gzip.open(path, 'at', encoding='utf-8')
+            self.stdout.write(f'archiving to {path}')
+        for row in Notification.objects.filter(pk__in=pks).order_by('pk').values(*ARCHIVE_FIELDS):
+            self.archive.write(json.dumps(row, cls=DjangoJSONEncoder))
+            self.archive.write('\n')
+        # make sure it is on disk before deleting
+        self.archive.flush()
@@ -1,14 +1,23 @@
+import copy
+import datetime
 import json
 import logging
+import math
+import os
+import socket
 import time
-from pathlib import Path
+from collections import defaultdict
 
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives, get_connection
 from django.core.management import BaseCommand
-from slack_sdk import WebClient, errors
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
 
-from notifications.models import Notification, Subscription
+from notifications import cache, coalesce, retry
+from notifications.backends import RateLimited, get_backends
+from notifications.models import Delivery, Notification, Priority, Subscription
+from notifications.wakeup import get_wakeup
 
 logger = logging.getLogger(__name__)
 
@@ -16,113 +25,355 @@ logger = logging.getLogger(__name__)
 class Command(BaseCommand):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.__sc = WebClient(settings.NOTIFICATIONS_SLACK_APP_TOKEN)
-        self.__slack_limited = time.time()
+        # delivery backend per service (NOTIFICATIONS_BACKENDS)
+        self.backends = get_backends()
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self.lease = settings.NOTIFICATIONS_SENDER_LEASE
+        self.batch_size = settings.NOTIFICATIONS_SENDER_BATCH_SIZE
+        # keyset pagination, per priority: (time, primary key) of the last row of the previous (full) batch, and
+        # when (time.monotonic) the lane started over
+        self._cursors = {}
+        # whether the last claim might have left pending notifications behind (a lane was full)
+        self._more = False
+        # status updates waiting to be written (status -> primary keys)
+        self.__status_updates = defaultdict(list)
+        self.__failed = []
+        self.__status_flushed = time.monotonic()
 
     def add_arguments(self, parser):
         parser.add_argument('-1', '--run-once', action='store_true', default=False, help='Run only one check')
+        parser.add_argument('--worker-id', type=str, help='Name used to claim notifications (defaults to hostname:pid)')
+        parser.add_argument(
+            '--lease',
+            type=int,
+            help='Seconds a claim is held before other senders can take over (defaults to NOTIFICATIONS_SENDER_LEASE)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            help='Maximum notifications processed per tick (defaults to NOTIFICATIONS_SENDER_BATCH_SIZE)',
+        )
+        parser.add_argument(
+            '--slack-concurrency',
+            type=int,
+            help='Maximum concurrent Slack API calls (defaults to NOTIFICATIONS_SLACK_CONCURRENCY)',
+        )
+
+    def claim(self):
+        """
+        Claim pending notifications for this worker so that multiple senders can run concurrently.
+        Rows are locked with SKIP LOCKED when the database supports it. Either way, the claim itself is a single
+        conditional UPDATE so two workers never get the same row, even on backends without row locking (SQLite).
+        Claims of crashed workers expire after `lease` seconds and are picked up by others.
+
+        At most `batch_size` rows are claimed, higher priorities first and oldest first within each priority (FIFO by
+        time and id, matching the partial index on pending notifications). Lower priorities only get their share of
+        the batch (NOTIFICATIONS_SENDER_LANE_SHARE) so a flood of those never makes for long batches, keeping latency
+        low for the higher ones. Each priority paginates on its own: the next call continues after the last row of a
+        full lane and starts over once a lane comes back short, its rows are released, or at least every
+        NOTIFICATIONS_SENDER_POLL_MAX seconds, so rows left behind (retried, released with a delay, or committed late
+        with an earlier time) are never skipped for long, even while the lane stays full.
+        """
+        now = timezone.now()
+        unclaimed = Q(claimed_until__isnull=True) | Q(claimed_until__lt=now)
+        shares = settings.NOTIFICATIONS_SENDER_LANE_SHARE
+        self._more = False
+        pks = []
+        with transaction.atomic():
+            for priority in sorted(Priority, reverse=True):
+                share = shares.get(priority.name.lower())
+                limit = self.batch_size - len(pks)
+                if share is not None:
+                    limit = min(limit, max(1, int(self.batch_size * share)))
+                if limit <= 0:
+                    break
+                qs = Notification.objects.filter(
+                    unclaimed,
+                    Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now),
+                    status=Notification.STATUS_PENDING,
+                    priority=priority,
+                )
+                cursor = self._cursors.get(priority)
+                if cursor is not None and time.monotonic() - cursor[2] > settings.NOTIFICATIONS_SENDER_POLL_MAX:
+                    cursor = None
+                if cursor is not None:
+                    qs = qs.filter(Q(time__gt=cursor[0]) | Q(time=cursor[0], pk__gt=cursor[1]))
+                if connection.features.has_select_for_update_skip_locked:
+                    qs = qs.select_for_update(skip_locked=True)
+                rows = list(qs.order_by('time', 'pk').values_list('time', 'pk')[:limit])
+                if len(rows) >= limit:
+                    self._cursors[priority] = (*rows[-1], time.monotonic() if cursor is None else cursor[2])
+                    self._more = True
+                else:
+                    self._cursors.pop(priority, None)
+                pks.extend(pk for _, pk in rows)
+            if not pks:
+                return []
+            Notification.objects.filter(unclaimed, pk__in=pks, status=Notification.STATUS_PENDING).update(
+                claimed_by=self.worker_id, claimed_until=now + datetime.timedelta(seconds=self.lease)
+            )
+        return list(
+            Notification.objects.filter(pk__in=pks, claimed_by=self.worker_id, status=Notification.STATUS_PENDING)
+            .select_related('subscription__event')
+            .order_by('-priority', 'time', 'pk')
+        )
+
+    def release(self, notifications, delay=None):
+        """
+        Release claims of notifications that were not processed (still pending) so they are picked up again.
+        With `delay` (seconds), the claim is kept until then instead, so the rows are not even read before that.
+        """
+        members = [m for n in notifications for m in coalesce.members(n)]
+        qs = Notification.objects.filter(
+            pk__in=[m.pk for m in members], claimed_by=self.worker_id, status=Notification.STATUS_PENDING
+        )
+        if delay:
+            qs.update(claimed_until=timezone.now() + datetime.timedelta(seconds=delay))
+        else:
+            qs.update(claimed_by=None, claimed_until=None)
+            # released rows are behind the cursor of their lane
+            for member in members:
+                self._cursors.pop(member.priority, None)
 
     def handle_tick(self):
-        for notification in Notification.objects.filter(status=Notification.STATUS_PENDING).select_related(
-            'subscription'
-        ):
+        """
+        Process one batch of pending notifications, returning how many were claimed
+        """
+        notifications = self.claim()
+        # load all the payloads of the batch (not cached yet) at once and attach them to their notifications, so they
+        # are never read again (whatever the cache size) nor from backend threads
+        payloads = cache.get_payloads({n.payload_id for n in notifications if n.payload_id is not None})
+        for notification in notifications:
+            if notification.payload_id in payloads:
+                notification.payload = payloads[notification.payload_id]
+        deferred = {}
+        try:
+            batch = self.__prepare(notifications)
+            by_service = defaultdict(list)
+            for notification in batch:
+                by_service[notification.subscription.service].append(notification)
+            for service, backend in self.backends.items():
+                if by_service.get(service):
+                    deferred.update(self.__deliver(backend, by_service.pop(service)))
+            for service, unknown in by_service.items():
+                for notification in unknown:
+                    self.__set_status(notification, Notification.STATUS_ERROR)
+                    logger.error('notify failed - %d - bad service %s', notification.pk, service)
+        finally:
+            # write status updates, even of a batch interrupted by an unexpected error
+            self.__flush_status()
+        for delay in set(deferred.values()):
+            self.release([n for n, d in deferred.items() if d == delay], delay=delay)
+        held = {m.pk for n in deferred for m in coalesce.members(n)}
+        self.release([n for n in notifications if n.status == Notification.STATUS_PENDING and n.pk not in held])
+        for backend in self.backends.values():
+            backend.end_batch()
+        return len(notifications)
+
+    def __prepare(self, notifications):
+        """
+        Notifications of the batch to hand over to backends, merged when coalesced (see coalesce.group).
+        The ones that cannot be delivered (subscriptions or payload deleted meanwhile) or fail to be merged are
+        recorded as failed here, so a single bad row never stops the sender (nor keeps its claim until the lease
+        expires).
+        """
+        self.__resolve_deliveries(notifications)
+        orphans = [n for n in notifications if n.subscription is None]
+        for notification in orphans:
+            self.__set_status(notification, Notification.STATUS_ERROR)
+            logger.error('notify failed - %d - subscription deleted', notification.pk)
+        notifications = [n for n in notifications if n.subscription is not None]
+        loaded = []
+        for notification in notifications:
             try:
-                if notification.subscription.service == Subscription.Service.SLACK:
-                    if self.__slack_limited < time.time():
-                        self.__send_slack_notifications(notification)
-                elif notification.subscription.service == Subscription.Service.MAIL:
-                    self.__send_email_notifications(notification)
-                else:
-                    notification.status = Notification.STATUS_ERROR
-                    logger.error(
-                        'notify failed - %d - bad service %s', notification.pk, notification.subscription.service
-                    )
+                # read here, backends (and their threads) never query the database
+                notification.content
             except Exception as e:
-                notification.status = Notification.STATUS_ERROR
-                notification.save()
                 logger.exception(e)
+                self.__set_failed(notification, e)
+            else:
+                loaded.append(notification)
+        notifications = loaded
+        try:
+            groups = coalesce.group(notifications)
+        except Exception as e:
+            # deliver them one by one instead, failing on their own
+            logger.exception(e)
+            groups = [[n] for n in notifications]
+        batch = []
+        for group in groups:
+            try:
+                batch.append(self.__merge(group))
+            except Exception as e:
+                logger.exception(e)
+                for notification in group:
+                    self.__set_failed(notification, e)
+        return batch
 
-    def handle(self, *args, **options):
+    @staticmethod
+    def __resolve_deliveries(notifications):
         """
-        Main method that starts the infinite loop to fetch for pending notifications.
-        When those exists, then it calls its sub methods to send Slack and Email notifications according to their types.
+        Shared (mail) notifications go to the subscriptions (deliveries) they still have: the recipients of the deleted
+        ones are left out and, if their own subscription was deleted, they are attached to one of those left.
         """
-        while True:
-            self.handle_tick()
-            if options['run_once']:
-                break
-            time.sleep(1)
+        shared = [
+            n for n in notifications if n.subscription is None or n.subscription.service == Subscription.Service.MAIL
+        ]
+        if not shared:
+            return
+        deliveries = defaultdict(list)
+        for delivery in Delivery.objects.filter(notification__in=shared).select_related('subscription__event'):
+            deliveries[delivery.notification_id].append(delivery)
+        for notification in shared:
+            left = [d for d in deliveries[notification.pk] if d.subscription is not None]
+            if not left:
+                # not shared, or no subscription left at all
+                continue
+            if notification.subscription is None:
+                notification.subscription = left[0].subscription
+            kept = {r.strip() for d in left for r in (d.target or d.subscription.target).split('\n')}
+            deleted = {
+                r.strip()
+                for d in deliveries[notification.pk]
+                if d.subscription is None
+                for r in (d.target or '').split('\n')
+            }
+            if deleted - kept:
+                notification.target = json.dumps(
+                    [r for r in json.loads(notification.target) if r not in deleted - kept]
+                )
 
-    def __send_slack_notifications(self, notification):
+    def __deliver(self, backend, notifications):
         """
-        Method responsible for handling slack notifications.
-        Provided a single notifications that still is in pending state and that its subscription type is slack,
-        then the method sends it using the slackclient module.
-        If the notification is sent successfully then it updates its Status field to to Status_SENT. Otherwise,
-        the Notification's Status property is changed to STATUS_ERROR.
-        :param notification: Set of notifications with SLACK subscription and PENDING status.
+        Hand `notifications` over to their backend, `batch_size` (of the backend) at a time, and record the results.
+        Sends are paced by the backend rate limits (rate_keys), so a rate limited key (such as a Slack channel) does
+        not hold back the others. Notifications that cannot be sent yet are returned with the seconds to wait.
+        :return: dict of notification to delay (seconds) for the ones left pending
         """
-        try:
-            self.__sc.chat_postMessage(
-                # text still required for message preview (in notifications)
-                text=notification.message,
-                channel=notification.target,
-                **notification.slack_options,
-            )
-            notification.status = Notification.STATUS_SENT
-            notification.save(update_fields=['status'])
-        except errors.SlackApiError as e:
-            if e.response.get('error') == 'ratelimited':
-                # handle rate limit
-                try:
-                    retry_after = int(e.response.headers.get('retry-after')) + 5
-                except (ValueError, TypeError):
-                    # if no header (weird), wait 15s
-                    retry_after = 15
-                self.__slack_limited = time.time() + retry_after
-                logger.warning('rate limited on %d - waiting %d secs', notification.pk, retry_after)
+        deferred = {}
+        to_send = []
+        for notification in notifications:
+            keys = backend.rate_keys(notification)
+            delay = backend.limiter.acquire(*keys) if keys else 0
+            if delay:
+                deferred[notification] = math.ceil(delay)
             else:
-                notification.status = Notification.STATUS_ERROR
-                logger.exception('notify failed - %d - %s', notification.pk, e.response.get('error'))
-                notification.save(update_fields=['status'])
-
-    def __send_email_notifications(self, notification):
-        """
-        Method responsible for sending email notifications.
-        Provided a single notification that still is in pending state and that is subscription type mail,
-        then the method sends it to the list of targets using the Django.Core.Email dependency.
-        If the email is sent successfully, then the Notification's status is changed to STATUS_SENT. Otherwise,
-        the Notification's status property is changed to STATUS_ERROR.
-        :param notification: Single notification of MAIL subscription with PENDING status.
-        """
-        email_args = json.loads(notification.options)
-        with get_connection() as connection:
-            msg = EmailMultiAlternatives(
-                subject=email_args.get('subject'),
-                body=notification.message,
-                from_email=email_args.get('from_email'),
-                to=json.loads(notification.target),
-                reply_to=email_args.get('reply_to'),
-                connection=connection,
+                to_send.append(notification)
+
+        size = backend.batch_size or len(to_send)
+        while to_send:
+            chunk, to_send = to_send[:size], to_send[size:]
+            try:
+                results = backend.send_batch(chunk)
+            except Exception as e:
+                logger.exception(e)
+                results = [e] * len(chunk)
+            for notification, result in zip(chunk, results):
+                if result is None:
+                    self.__set_status(notification, Notification.STATUS_SENT)
+                elif isinstance(result, RateLimited):
+                    keys = backend.rate_keys(notification)
+                    if keys:
+                        backend.limiter.block(keys[-1], result.retry_after)
+                    deferred[notification] = result.retry_after
+                    logger.warning(
+                        'rate limited on %d (%s) - waiting %d secs',
+                        notification.pk,
+                        notification.target,
+                        result.retry_after,
+                    )
+                else:
+                    logger.error('notify failed - %d - %s', notification.pk, result, exc_info=result)
+                    self.__set_failed(notification, result)
+        return deferred
+
+    def __merge(self, notifications):
+        """
+        Single (unsaved) notification delivering all of `notifications` (see coalesce.group).
+        Slack messages are merged here, emails by their backend (templates might need to be rendered first).
+        """
+        if len(notifications) == 1:
+            return notifications[0]
+        merged = copy.copy(notifications[0])
+        merged.coalesced = notifications
+        if merged.subscription.service == Subscription.Service.SLACK:
+            message, options = coalesce.merge_slack(notifications)
+            merged.content = message, options
+            merged.slack_options = options
+        return merged
+
+    def __set_status(self, notification, status):
+        """
+        Update notification status, only written to the database by __flush_status().
+        Buffered updates might be lost (if the process is killed) but that only means notifications are sent again:
+        nothing is ever marked as sent before it is.
+        """
+        notification.status = status
+        for member in coalesce.members(notification):
+            member.status = status
+            self.__status_updates[status].append(member.pk)
+        if time.monotonic() - self.__status_flushed > settings.NOTIFICATIONS_SENDER_FLUSH_INTERVAL:
+            self.__flush_status()
+
+    def __set_failed(self, notification, exc):
+        """
+        Record a failed delivery attempt (buffered, like __set_status).
+        Transient errors are retried with exponential backoff (NOTIFICATIONS_RETRY_POLICIES), moving to STATUS_DEAD
+        once out of attempts. Anything else is a permanent STATUS_ERROR.
+        """
+        for member in coalesce.members(notification):
+            member.attempts += 1
+            member.last_error = f'{type(exc).__name__}: {exc}'
+            if not retry.is_transient(exc):
+                member.status = Notification.STATUS_ERROR
+            else:
+                delay = retry.next_delay(member.subscription.service, member.attempts)
+                if delay is None:
+                    member.status = Notification.STATUS_DEAD
+                else:
+                    member.next_attempt_at = timezone.now() + datetime.timedelta(seconds=delay)
+                    logger.warning('notify failed - %d - retrying in %d secs', member.pk, delay)
+            self.__failed.append(member)
+        if time.monotonic() - self.__status_flushed > settings.NOTIFICATIONS_SENDER_FLUSH_INTERVAL:
+            self.__flush_status()
+
+    def __flush_status(self):
+        """
+        Write buffered status updates, one UPDATE per status (and one for all failed attempts)
+        """
+        for status, pks in self.__status_updates.items():
+            Notification.objects.filter(pk__in=pks).update(status=status)
+        self.__status_updates.clear()
+        if self.__failed:
+            Notification.objects.bulk_update(
+                self.__failed, ['status', 'attempts', 'next_attempt_at', 'last_error'], batch_size=self.batch_size
             )
-            if email_args.get("attachments"):
-                MEDIA_ROOT = Path(settings.MEDIA_ROOT).resolve()
-                for attach in email_args.get("attachments"):
-                    path = Path(attach[1]).resolve()
-                    try:
-                        # check if path is relative to MEDIA_ROOT
-                        path.relative_to(MEDIA_ROOT)
-                    except ValueError:
-                        logger.error('invalid path for attachment: %s', path)
-                        continue
-
-                    if path.exists() and not path.is_dir():
-                        with path.open() as attachment:
-                            msg.attach(attach[0], attachment.read(), attach[2])
-                    else:
-                        logger.error('could not open file from path: %s', path)
-            if email_args.get('html_message'):
-                msg.attach_alternative(email_args.get('html_message'), 'text/html')
-            msg.send()
-            notification.status = Notification.STATUS_SENT
-            notification.save(update_fields=['status'])
+            self.__failed.clear()
+        self.__status_flushed = time.monotonic()
+
+    def handle(self, *args, **options):
+        """
+        Main method that starts the infinite loop to fetch for pending notifications.
+        When those exists, then it calls its sub methods to send Slack and Email notifications according to their types.
+        """
+        if options['worker_id']:
+            self.worker_id = options['worker_id']
+        if options['lease']:
+            self.lease = options['lease']
+        if options['batch_size']:
+            self.batch_size = options['batch_size']
+        if options['slack_concurrency'] and Subscription.Service.SLACK in self.backends:
+            self.backends[Subscription.Service.SLACK].concurrency = options['slack_concurrency']
+        wakeup = get_wakeup()
+        try:
+            while True:
+                claimed = self.handle_tick()
+                if options['run_once']:
+                    break
+                if not self._more:
+                    # only wait when the backlog is drained, otherwise go straight to the next batch
+                    wakeup.wait(busy=claimed > 0)
+        finally:
+            wakeup.close()
+            for backend in self.backends.values():
+                backend.close()
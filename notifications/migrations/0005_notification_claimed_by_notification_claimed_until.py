@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0004_notification_notificatio_status_d92267_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notification",
+            name="claimed_by",
+            field=models.CharField(
+                blank=True,
+                help_text="Sender worker that claimed this notification",
+                max_length=100,
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="notification",
+            name="claimed_until",
+            field=models.DateTimeField(
+                blank=True,
+                help_text="Claim (lease) expiration, other senders may pick it up after this",
+                null=True,
+            ),
+        ),
+    ]
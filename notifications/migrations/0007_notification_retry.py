@@ -0,0 +1,41 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0006_delivery"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notification",
+            name="attempts",
+            field=models.PositiveIntegerField(default=0, help_text="Failed delivery attempts"),
+        ),
+        migrations.AddField(
+            model_name="notification",
+            name="last_error",
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="notification",
+            name="next_attempt_at",
+            field=models.DateTimeField(blank=True, help_text="Not retried before this", null=True),
+        ),
+        migrations.AlterField(
+            model_name="notification",
+            name="status",
+            field=models.IntegerField(
+                choices=[
+                    (0, "Pending"),
+                    (1, "Sent"),
+                    (-1, "Error"),
+                    (-2, "Dead (too many attempts)"),
+                ],
+                default=0,
+            ),
+        ),
+    ]
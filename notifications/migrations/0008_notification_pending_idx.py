@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:34
+
+from django.db import migrations, models
+
+from notifications.operations import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY (PostgreSQL) cannot run in a transaction
+    atomic = False
+
+    dependencies = [
+        ("notifications", "0007_notification_retry"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="notification",
+            index=models.Index(
+                condition=models.Q(("status", 0)),
+                fields=["time", "id"],
+                name="notifications_pending_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:36
+
+from django.db import migrations, models
+
+
+def move_html_message(apps, schema_editor):
+    Notification = apps.get_model('notifications', 'Notification')
+    batch = []
+    for notification in (
+        Notification.objects.filter(options__has_key='html_message').only('pk', 'options').iterator(chunk_size=1000)
+    ):
+        notification.html_message = notification.options.pop('html_message')
+        batch.append(notification)
+        if len(batch) >= 1000:
+            Notification.objects.bulk_update(batch, ['options', 'html_message'])
+            batch = []
+    Notification.objects.bulk_update(batch, ['options', 'html_message'])
+
+
+def restore_html_message(apps, schema_editor):
+    Notification = apps.get_model('notifications', 'Notification')
+    batch = []
+    for notification in (
+        Notification.objects.filter(html_message__isnull=False)
+        .only('pk', 'options', 'html_message')
+        .iterator(chunk_size=1000)
+    ):
+        notification.options = {**(notification.options or {}), 'html_message': notification.html_message}
+        batch.append(notification)
+        if len(batch) >= 1000:
+            Notification.objects.bulk_update(batch, ['options'])
+            batch = []
+    Notification.objects.bulk_update(batch, ['options'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0008_notification_pending_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="notification",
+            name="html_message",
+            field=models.TextField(blank=True, default=None, null=True),
+        ),
+        migrations.AlterField(
+            model_name="notification",
+            name="options",
+            field=models.JSONField(default=None, null=True),
+        ),
+        migrations.RunPython(move_html_message, restore_html_message),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:39
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0009_notification_options_json"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Payload",
+            fields=[
+                (
+                    "hash",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("message", models.TextField()),
+                ("options", models.JSONField(default=None, null=True)),
+                (
+                    "last_used",
+                    models.DateTimeField(
+                        auto_now=True,
+                        help_text="Last time a notification was created with it",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Payload",
+                "verbose_name_plural": "Payloads",
+            },
+        ),
+        migrations.AddField(
+            model_name="notification",
+            name="payload",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.PROTECT,
+                to="notifications.payload",
+            ),
+        ),
+    ]
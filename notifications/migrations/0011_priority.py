@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:48
+
+from django.db import migrations, models
+
+from notifications.operations import AddIndexConcurrently, RemoveIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # DROP / CREATE INDEX CONCURRENTLY (PostgreSQL) cannot run in a transaction
+    atomic = False
+
+    dependencies = [
+        ("notifications", "0010_payload"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="event",
+            name="priority",
+            field=models.IntegerField(
+                choices=[(-1, "Low"), (0, "Normal"), (1, "High")],
+                default=0,
+                help_text="Default priority of its notifications",
+            ),
+        ),
+        migrations.AddField(
+            model_name="notification",
+            name="priority",
+            field=models.IntegerField(choices=[(-1, "Low"), (0, "Normal"), (1, "High")], default=0),
+        ),
+        RemoveIndexConcurrently(
+            model_name="notification",
+            name="notifications_pending_idx",
+        ),
+        AddIndexConcurrently(
+            model_name="notification",
+            index=models.Index(
+                condition=models.Q(("status", 0)),
+                fields=["priority", "time", "id"],
+                name="notifications_pending_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0011_priority"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="event",
+            name="coalesce_window",
+            field=models.PositiveIntegerField(
+                blank=True,
+                help_text="If set, its notifications are held for up to this many seconds and the ones for the same "
+                "subscription and target are delivered together (a single Slack message or email)",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-16 22:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0012_event_coalesce_window"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="subscription",
+            name="service",
+            field=models.CharField(choices=[("S", "Slack"), ("M", "Mail"), ("W", "Webhook")], max_length=1),
+        ),
+    ]
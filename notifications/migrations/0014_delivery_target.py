@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("notifications", "0013_subscription_webhook"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="delivery",
+            name="target",
+            field=models.TextField(default=None, help_text="Targets of the subscription when notified", null=True),
+        ),
+        migrations.AlterField(
+            model_name="delivery",
+            name="subscription",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="notifications.subscription",
+            ),
+        ),
+    ]
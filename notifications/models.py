@@ -1,9 +1,21 @@
+import hashlib
 import json
 
 from django.db import models
+from django.utils.functional import cached_property
 from django.template.defaultfilters import truncatechars
 
 
+class Priority(models.IntegerChoices):
+    """
+    notification_sender lanes, higher ones are sent first
+    """
+
+    LOW = -1
+    NORMAL = 0
+    HIGH = 1
+
+
 class Event(models.Model):
     name = models.CharField(max_length=50, primary_key=True)
     external_token = models.CharField(
@@ -24,6 +36,15 @@ class Event(models.Model):
     mail_reply_to = models.CharField(
         max_length=200, null=True, blank=True, help_text='Choose the reply-to address of the email (instead of none)'
     )
+    priority = models.IntegerField(
+        choices=Priority.choices, default=Priority.NORMAL, help_text='Default priority of its notifications'
+    )
+    coalesce_window = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text='If set, its notifications are held for up to this many seconds and the ones for the same '
+        'subscription and target are delivered together (a single Slack message or email)',
+    )
 
     def __str__(self) -> str:
         return self.name
@@ -50,6 +71,7 @@ class Subscription(models.Model):
     class Service(models.TextChoices):
         SLACK = 'S'
         MAIL = 'M'
+        WEBHOOK = 'W'
 
     event = models.ForeignKey('Event', null=True, on_delete=models.CASCADE)
     service = models.CharField(max_length=1, choices=Service.choices)
@@ -64,7 +86,36 @@ class Subscription(models.Model):
         verbose_name_plural = 'Subscriptions'
 
 
+class Payload(models.Model):
+    """
+    message and options of notifications, stored once and addressed by their hash: an event fanning out to many
+    targets writes a single payload instead of the same (possibly large) message and blocks for each one.
+    Payloads are never modified, notification_prune deletes the ones no longer used.
+    """
+
+    hash = models.CharField(max_length=64, primary_key=True)
+    message = models.TextField()
+    options = models.JSONField(null=True, default=None)
+    last_used = models.DateTimeField(auto_now=True, help_text='Last time a notification was created with it')
+
+    def __str__(self) -> str:
+        return self.hash
+
+    @classmethod
+    def build(cls, message, options=None):
+        """
+        (unsaved) payload for `message` and `options`
+        """
+        content = json.dumps([message, options], sort_keys=True, separators=(',', ':'))
+        return cls(hash=hashlib.sha256(content.encode()).hexdigest(), message=message, options=options)
+
+    class Meta:
+        verbose_name = 'Payload'
+        verbose_name_plural = 'Payloads'
+
+
 class Notification(models.Model):
+    STATUS_DEAD = -2
     STATUS_ERROR = -1
     STATUS_PENDING = 0
     STATUS_SENT = 1
@@ -73,28 +124,60 @@ class Notification(models.Model):
         (STATUS_PENDING, 'Pending'),
         (STATUS_SENT, 'Sent'),
         (STATUS_ERROR, 'Error'),
+        (STATUS_DEAD, 'Dead (too many attempts)'),
     )
     time = models.DateTimeField(auto_now_add=True)
     subscription = models.ForeignKey('notifications.Subscription', null=True, on_delete=models.deletion.SET_NULL)
+    # message and options are empty when set in payload
     message = models.TextField()
     status = models.IntegerField(default=0, choices=STATUS_TYPES)
+    priority = models.IntegerField(choices=Priority.choices, default=Priority.NORMAL)
     target = models.TextField(null=True, default=None)
-    options = models.TextField(null=True, default=None)
+    options = models.JSONField(null=True, default=None)
+    payload = models.ForeignKey('notifications.Payload', null=True, blank=True, on_delete=models.PROTECT)
+    # kept apart from options so that queries that do not need it (lists) can defer it
+    html_message = models.TextField(null=True, blank=True, default=None)
+    claimed_by = models.CharField(
+        max_length=100, null=True, blank=True, help_text='Sender worker that claimed this notification'
+    )
+    claimed_until = models.DateTimeField(
+        null=True, blank=True, help_text='Claim (lease) expiration, other senders may pick it up after this'
+    )
+    attempts = models.PositiveIntegerField(default=0, help_text='Failed delivery attempts')
+    next_attempt_at = models.DateTimeField(null=True, blank=True, help_text='Not retried before this')
+    last_error = models.TextField(null=True, blank=True)
 
     def __str__(self) -> str:
         return f'[{self.get_status_display()}] {self.subscription}'
 
+    @cached_property
+    def content(self):
+        """
+        (message, options) of this notification, read from its payload (through the payload cache unless already
+        loaded) if it has one
+        """
+        if self.payload_id is None:
+            return self.message, self.options
+        if Notification.payload.is_cached(self):
+            return self.payload.message, self.payload.options
+        from notifications import cache
+
+        payload = cache.get_payload(self.payload_id)
+        return payload.message, payload.options
+
     @property
-    def options_dict(self):
-        if self.options:
-            return json.loads(self.options)
-        return {}
+    def message_text(self):
+        return self.content[0]
 
     @property
+    def options_dict(self):
+        return self.content[1] or {}
+
+    @cached_property
     def slack_options(self):
-        options = self.options_dict
+        options = dict(self.options_dict)
         if 'blocks' not in options:
-            options['blocks'] = [{"type": "section", "text": {"type": "mrkdwn", "text": self.message}}]
+            options['blocks'] = [{"type": "section", "text": {"type": "mrkdwn", "text": self.message_text}}]
         return options
 
     class Meta:
@@ -102,4 +185,30 @@ class Notification(models.Model):
         verbose_name_plural = 'Notifications'
         indexes = [
             models.Index(fields=['status']),
+            # notification_sender dequeue: pending rows of each priority, oldest first
+            models.Index(
+                fields=['priority', 'time', 'id'],
+                condition=models.Q(status=0),
+                name='notifications_pending_idx',
+            ),
         ]
+
+
+class Delivery(models.Model):
+    """
+    subscriptions covered by a notification: a single mail notification is shared by all the mail subscriptions
+    of an event, so each recipient gets one email. Status is the one of the notification.
+    Deliveries outlive their subscription, keeping its targets: notification_sender leaves those recipients out if
+    it is deleted before the email is sent.
+    """
+
+    notification = models.ForeignKey('notifications.Notification', on_delete=models.CASCADE)
+    subscription = models.ForeignKey('notifications.Subscription', null=True, on_delete=models.SET_NULL)
+    target = models.TextField(null=True, default=None, help_text='Targets of the subscription when notified')
+
+    def __str__(self) -> str:
+        return f'{self.notification} - {self.subscription}'
+
+    class Meta:
+        verbose_name = 'Delivery'
+        verbose_name_plural = 'Deliveries'
@@ -0,0 +1,57 @@
+import threading
+import time
+
+
+class TokenBucketScheduler:
+    """
+    token buckets per key, to pace API calls (such as Slack's "1 message per second per channel").
+
+    keys are (scope, value) tuples, such as ('method', 'chat.postMessage') or ('channel', '#general'),
+    and `limits` maps each scope to its (tokens per second, burst) - scopes without limits are never delayed.
+    keys can also be blocked for a fixed time, to honour a Retry-After sent by the API.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self._buckets = {}
+        self._blocked = {}
+        self._lock = threading.Lock()
+
+    def _refill(self, key, now):
+        rate, burst = self.limits[key[0]]
+        tokens, last = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        self._buckets[key] = (tokens, now)
+        return tokens
+
+    def _delay(self, key, now):
+        delay = self._blocked.get(key, 0) - now
+        if key[0] in self.limits:
+            rate, _ = self.limits[key[0]]
+            tokens = self._refill(key, now)
+            if tokens < 1:
+                delay = max(delay, (1 - tokens) / rate)
+        return max(delay, 0)
+
+    def acquire(self, *keys):
+        """
+        take one token from each of `keys` if all of them have one available, returning 0.
+        otherwise nothing is taken and the number of seconds to wait before trying again is returned.
+        """
+        with self._lock:
+            now = time.time()
+            delay = max(self._delay(key, now) for key in keys)
+            if delay:
+                return delay
+            for key in keys:
+                if key[0] in self.limits:
+                    tokens, last = self._buckets[key]
+                    self._buckets[key] = (tokens - 1, last)
+            return 0
+
+    def block(self, key, seconds):
+        """
+        delay any call to `key` for (at least) `seconds`
+        """
+        with self._lock:
+            self._blocked[key] = max(self._blocked.get(key, 0), time.time() + seconds)
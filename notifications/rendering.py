@@ -0,0 +1,166 @@
+"""
+templated mail rendering, used by notify() and, for deferred templates, notification_sender.
+
+compiled templates are cached by name (whatever the configured template loaders), with DEBUG on they are reloaded
+when their file changes (only the template itself is checked, not the ones it extends or includes).
+rendered parts (subject, body and html) of the last NOTIFICATIONS_TEMPLATE_RENDER_CACHE_SIZE renders are reused
+when the same template is rendered with the same (JSON serialisable) context.
+"""
+
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.template import Context, loader
+from django.template.autoreload import reset_loaders
+from django.utils import translation
+from render_block import BlockNotFound
+from render_block.django import django_render_block
+from templated_email.backends.vanilla_django import EmailRenderException, TemplateBackend
+
+_templates = {}
+_renders = OrderedDict()
+_lock = threading.Lock()
+
+
+def defer_template(defer, context):
+    """
+    whether a templated mail should be rendered by notification_sender instead of notify().
+    `defer` overrides NOTIFICATIONS_DEFER_TEMPLATES when not None.
+    contexts that cannot be stored as JSON (such as model instances) are always rendered straight away
+    """
+    if defer is None:
+        defer = settings.NOTIFICATIONS_DEFER_TEMPLATES
+    if not defer:
+        return False
+    try:
+        json.dumps(context)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def template_options(template, context, create_link=False):
+    """
+    mail options to render `template` later on (see render_mail)
+    """
+    return {'template': {'name': template, 'context': context, 'create_link': create_link}}
+
+
+def render_mail(template, context, from_email=None, to=None, create_link=False):
+    """
+    render templated mail, returning (subject, body, html_message)
+    """
+    # with create_link, each render has its own context (link uuid)
+    template_message = CachedTemplateBackend(memoize=not create_link).get_email_message(
+        template,
+        # copy, create_link adds to it
+        context=dict(context or {}),
+        from_email=from_email,
+        create_link=create_link,
+        to=to,
+    )
+    html_message = None
+    for alt in getattr(template_message, 'alternatives', ()):
+        if alt[1] == 'text/html':
+            html_message = alt[0]
+            break
+    return template_message.subject, template_message.body, html_message
+
+
+def _mtime(template):
+    try:
+        return os.stat(template.origin.name).st_mtime
+    except (OSError, TypeError, AttributeError):
+        # not loaded from a file
+        return None
+
+
+def get_template(names):
+    """
+    compiled template, first one found of `names`
+    """
+    entry = _templates.get(names)
+    if entry is not None and settings.DEBUG and entry[1] != _mtime(entry[0]):
+        # changed: reset template loaders (their own caches) and renders as well
+        reset_loaders()
+        with _lock:
+            _renders.clear()
+        entry = None
+    if entry is None:
+        template = loader.select_template(names)
+        entry = (template, _mtime(template))
+        with _lock:
+            _templates[names] = entry
+    return entry[0]
+
+
+def clear():
+    with _lock:
+        _templates.clear()
+        _renders.clear()
+
+
+def _render_key(names, context):
+    try:
+        return names, translation.get_language(), json.dumps(context, sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+
+
+class CachedTemplateBackend(TemplateBackend):
+    """
+    templated_email backend rendering through the template and render caches above.
+    it overrides (and uses) private methods of TemplateBackend, hence the pinned django-templated-email versions
+    """
+
+    def __init__(self, memoize=True, **kwargs):
+        super().__init__(**kwargs)
+        self.memoize = memoize
+
+    def _render_email(self, template_name, context, template_dir=None, file_extension=None):
+        file_extension = file_extension or self.template_suffix
+        if file_extension.startswith('.'):
+            file_extension = file_extension[1:]
+        template_extension = f'.{file_extension}'
+        if not isinstance(template_name, (tuple, list)):
+            template_name = [template_name]
+        names = []
+        for name in template_name:
+            name = f'{template_dir or self.template_prefix}{name}'
+            if not name.endswith(template_extension):
+                name += template_extension
+            names.append(name)
+        names = tuple(names)
+
+        template = get_template(names)
+        size = settings.NOTIFICATIONS_TEMPLATE_RENDER_CACHE_SIZE
+        key = _render_key(names, context) if size and self.memoize else None
+        if key is not None:
+            with _lock:
+                parts = _renders.get(key)
+                if parts is not None:
+                    _renders.move_to_end(key)
+                    return dict(parts)
+
+        parts = {}
+        errors = {}
+        for part in ('subject', 'html', 'plain'):
+            try:
+                parts[part] = django_render_block(template, part, Context(context, autoescape=(part == 'html')))
+            except BlockNotFound as error:
+                errors[part] = error
+        if not parts:
+            raise EmailRenderException(f"Couldn't render email parts. Errors: {errors}")
+        if 'plain' not in parts:
+            # (html2text) generated here so it is memoized as well
+            self._generate_plain_part(parts)
+
+        if key is not None:
+            with _lock:
+                _renders[key] = parts
+                while len(_renders) > size:
+                    _renders.popitem(last=False)
+        return dict(parts)
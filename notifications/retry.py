@@ -0,0 +1,59 @@
+import random
+import smtplib
+
+from django.conf import settings
+from slack_sdk.errors import SlackApiError
+
+from notifications.apps import APP_SETTINGS
+from notifications.httppool import HTTPError
+
+# slack API errors worth retrying (besides HTTP 5xx)
+TRANSIENT_SLACK_ERRORS = {'internal_error', 'fatal_error', 'service_unavailable', 'request_timeout'}
+
+
+def is_transient(exc):
+    """
+    whether delivery failed due to a temporary issue (SMTP 4xx, Slack or webhook 5xx, network errors) and should be
+    retried
+    """
+    if isinstance(exc, HTTPError):
+        return exc.status >= 500 or exc.status in (408, 429)
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return bool(exc.recipients) and all(400 <= code < 500 for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPException) and not isinstance(exc, smtplib.SMTPServerDisconnected):
+        # SMTPNotSupportedError and the like: retrying gets the same answer (every SMTPException is an OSError)
+        return False
+    if isinstance(exc, SlackApiError):
+        status_code = getattr(exc.response, 'status_code', None)
+        if isinstance(status_code, int) and status_code >= 500:
+            return True
+        return exc.response.get('error') in TRANSIENT_SLACK_ERRORS
+    # connection errors and timeouts (including SMTPServerDisconnected)
+    return isinstance(exc, OSError)
+
+
+def get_policy(service):
+    """
+    retry policy for `service`: NOTIFICATIONS_RETRY_POLICIES['default'] (the built-in one if missing) updated with the
+    service specific one
+    """
+    policies = settings.NOTIFICATIONS_RETRY_POLICIES
+    return {
+        **APP_SETTINGS['RETRY_POLICIES']['default'],
+        **policies.get('default', {}),
+        **policies.get(service, {}),
+    }
+
+
+def next_delay(service, attempts):
+    """
+    seconds to wait before another attempt, after `attempts` failed ones, or None if there should be no more.
+    exponential backoff with jitter (between half and the full delay) so retries of a burst of failures spread out
+    """
+    policy = get_policy(service)
+    if attempts >= policy['max_attempts']:
+        return None
+    delay = min(policy['max_backoff'], policy['backoff'] * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
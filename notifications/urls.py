@@ -2,4 +2,8 @@ from django.urls import path
 
 from notifications import views
 
-urlpatterns = [path('notify/', views.notify, name='notify')]
+urlpatterns = [
+    path('notify/', views.notify, name='notify'),
+    path('notify/async/', views.anotify, name='anotify'),
+    path('notify/batch/', views.notify_batch, name='notify_batch'),
+]
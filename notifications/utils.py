@@ -1,13 +1,15 @@
 import json
 import logging
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives, get_connection, message
-from templated_email import get_templated_mail
+from django.db import connection, transaction
+from django.utils import timezone
 from typing import NamedTuple, Optional
 
-from notifications.models import Event, Notification, Subscription
-from . import blocks
+from notifications.models import Delivery, Event, Notification, Payload, Priority, Subscription
+from . import blocks, cache, coalesce, dedup, rendering, wakeup
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +35,160 @@ def send_event_email(event, subject, message, recipient_list, html_message=None)
         return bool(msg.send())
 
 
+def _store_payloads(notifications):
+    """
+    create the payloads of `notifications` that do not exist yet, and mark the existing ones as used
+    (so notification_prune does not delete them)
+    """
+    payloads = {n.payload_id: n.payload for n in notifications if n.payload_id is not None}
+    if not payloads:
+        return
+    if connection.features.supports_update_conflicts:
+        kwargs = {}
+        if connection.features.supports_update_conflicts_with_target:
+            kwargs['unique_fields'] = ['hash']
+        Payload.objects.bulk_create(
+            payloads.values(),
+            batch_size=settings.NOTIFICATIONS_BULK_BATCH_SIZE,
+            update_conflicts=True,
+            update_fields=['last_used'],
+            **kwargs,
+        )
+        return
+    existing = set(Payload.objects.filter(pk__in=payloads).values_list('pk', flat=True))
+    Payload.objects.filter(pk__in=existing).update(last_used=timezone.now())
+    Payload.objects.bulk_create(
+        [p for h, p in payloads.items() if h not in existing], batch_size=settings.NOTIFICATIONS_BULK_BATCH_SIZE
+    )
+
+
+def _bulk_store(notifications, deliveries=()):
+    """
+    write all the notifications (and deliveries and payloads) built for a single notify() call in one transaction,
+    batched by NOTIFICATIONS_BULK_BATCH_SIZE
+    """
+    if notifications:
+        with transaction.atomic():
+            _store_payloads(notifications)
+            if deliveries and not connection.features.can_return_rows_from_bulk_insert:
+                # deliveries need the primary key of their notification, save those one by one
+                shared = {id(d.notification): d.notification for d in deliveries}
+                for notification in shared.values():
+                    notification.save()
+            else:
+                shared = {}
+            Notification.objects.bulk_create(
+                [n for n in notifications if id(n) not in shared], batch_size=settings.NOTIFICATIONS_BULK_BATCH_SIZE
+            )
+            Delivery.objects.bulk_create(deliveries, batch_size=settings.NOTIFICATIONS_BULK_BATCH_SIZE)
+            wakeup.notify_pending()
+    return notifications
+
+
+def _deleted_subscriptions(notifications, deliveries):
+    """
+    pks of the subscriptions of `notifications` and `deliveries` deleted since they were looked up: cached ones
+    (NOTIFICATIONS_CACHE_TIMEOUT) are not invalidated by deletes in other processes (nor raw SQL ones)
+    """
+    if not settings.NOTIFICATIONS_CACHE_TIMEOUT:
+        return set()
+    pks = {n.subscription_id for n in notifications} | {d.subscription_id for d in deliveries}
+    pks.discard(None)
+    if not pks:
+        return set()
+    return pks - set(Subscription.objects.filter(pk__in=pks).values_list('pk', flat=True))
+
+
+def _without_deleted(notifications, deliveries, deleted):
+    """
+    (notifications, deliveries, count) but the ones of `deleted` subscriptions, `count` being how many of those
+    notify() counted (deliveries and notifications without any). shared notifications are kept, attached to one of
+    their subscriptions left, as long as they have any
+    """
+    if not deleted:
+        return notifications, deliveries, 0
+    shared = {id(d.notification) for d in deliveries}
+    kept_deliveries = [d for d in deliveries if d.subscription_id not in deleted]
+    left = {}
+    for delivery in kept_deliveries:
+        left.setdefault(id(delivery.notification), delivery.subscription)
+    kept = []
+    for notification in notifications:
+        if id(notification) in shared:
+            if id(notification) not in left:
+                continue
+            if notification.subscription_id in deleted:
+                notification.subscription = left[id(notification)]
+        elif notification.subscription_id in deleted:
+            continue
+        kept.append(notification)
+    dropped = len(deliveries) - len(kept_deliveries)
+    dropped += sum(1 for n in notifications if id(n) not in shared and n.subscription_id in deleted)
+    return kept, kept_deliveries, dropped
+
+
+def _store(event, notifications, deliveries=()):
+    """
+    _bulk_store() the notifications of `event` but the ones of subscriptions deleted meanwhile (invalidating its cache
+    entry), returning how many of those notify() counted
+    """
+    deleted = _deleted_subscriptions(notifications, deliveries)
+    if deleted:
+        logger.info('%d subscriptions of %s deleted meanwhile', len(deleted), event.name)
+        cache.invalidate(event.name)
+    notifications, deliveries, dropped = _without_deleted(notifications, deliveries, deleted)
+    _bulk_store(notifications, deliveries)
+    return dropped
+
+
+def _shared_notification(targets, **kwargs):
+    """
+    build a single (unsaved) notification for all the `targets` subscriptions, linked to each through a Delivery
+    """
+    notification = Notification(subscription=targets[0], **kwargs)
+    return notification, [
+        Delivery(notification=notification, subscription=target, target=target.target) for target in targets
+    ]
+
+
+def _priority(event, priority):
+    """
+    priority of the notifications of `event`: `priority` if set, the event default otherwise
+    """
+    return event.priority if priority is None else Priority(priority)
+
+
+def _webhook_notifications(targets, payload, priority):
+    """
+    build (unsaved) notifications of `payload` for each URL of the webhook `targets` subscriptions
+    """
+    return [
+        Notification(subscription=subscription, target=url.strip(), payload=payload, priority=priority)
+        for subscription in targets
+        for url in subscription.target.split('\n')
+        if url.strip()
+    ]
+
+
+def _get_subscriptions(event_name, queryset):
+    """
+    return event and its enabled subscriptions (limited to `queryset`, if any)
+    """
+    if event_name is not None:
+        if queryset is None:
+            return cache.get_event(event_name)
+        event = Event.objects.get(name=event_name)
+        return event, tuple(queryset.filter(enabled=True))
+    if queryset is None:
+        return None, ()
+    subscriptions = tuple(queryset.select_related('event').order_by('pk'))
+    if not subscriptions:
+        return None, ()
+    # enabled flag does not really matter here
+    event = subscriptions[0].event
+    return event, tuple(s for s in subscriptions if s.enabled)
+
+
 def notify_templated(event_name, template, context, **kwargs):
     return notify(
         event_name,
@@ -43,65 +199,70 @@ def notify_templated(event_name, template, context, **kwargs):
     )
 
 
-def __notify_blocks(event_name, block, queryset=None):
+def __notify_blocks(event_name, block, queryset=None, priority=None):
     """
     ALPHA method to experiment with block building to simplify all the extra options
     check blocks.py for the supported blocks!
     """
-    if event_name is not None:
-        event = Event.objects.get(name=event_name)
-        if queryset is None:
-            queryset = event.subscription_set
-    elif queryset:
-        # enabled flag does not really matter here
-        event = queryset.first().event
-    else:
+    event, subscriptions = _get_subscriptions(event_name, queryset)
+    if event is None:
         return 0
+    priority = _priority(event, priority)
 
     count = 0
+    notifications = []
+    deliveries = []
 
-    queryset = queryset.filter(enabled=True)
-    targets = queryset.filter(service=Subscription.Service.SLACK)
+    targets = [s for s in subscriptions if s.service == Subscription.Service.SLACK]
     if targets:
         api_kwargs = event.slack_api_kwargs()
         message, extra_kwargs = block.render_slack()
         api_kwargs.update(extra_kwargs)
+        payload = Payload.build(message, api_kwargs)
         for subscription in targets:
             for target in subscription.target.split('\n'):
-                Notification.objects.create(
-                    subscription=subscription, message=message, target=target.strip(), options=json.dumps(api_kwargs)
+                notifications.append(
+                    Notification(subscription=subscription, target=target.strip(), payload=payload, priority=priority)
                 )
                 count += 1
 
-    targets = queryset.filter(service=Subscription.Service.MAIL)
+    targets = [s for s in subscriptions if s.service == Subscription.Service.WEBHOOK]
+    if targets:
+        message, options = block.render_webhook()
+        webhook_notifications = _webhook_notifications(targets, Payload.build(message, options), priority)
+        notifications.extend(webhook_notifications)
+        count += len(webhook_notifications)
+
+    targets = [s for s in subscriptions if s.service == Subscription.Service.MAIL]
     if targets:
         try:
-            recipient_list = {
-                mail.strip() for target in targets.values_list('target', flat=True) for mail in target.split('\n')
-            }
+            recipient_list = {mail.strip() for target in targets for mail in target.target.split('\n')}
             mail_body, options = block.render_mail(
                 from_email=event.mail_from or settings.NOTIFICATIONS_MAIL_FROM,
                 recipient_list=recipient_list,
             )
             recipient_list.update(set(options.get('recipient_list', [])))
-            recipient_list = list(recipient_list)
+            # sorted: the same target whatever the process (set order), for coalescing
+            recipient_list = sorted(recipient_list)
             options['reply_to'] = [event.mail_reply_to] if event.mail_reply_to else None
 
-            # FIXME: add html_message and attachments!
+            # FIXME: add attachments!
 
-            for target in targets:
-                Notification.objects.create(
-                    subscription=target,
-                    target=json.dumps(recipient_list),
-                    message=mail_body,
-                    options=json.dumps(options),
-                    status=Notification.STATUS_PENDING,
-                )
+            notification, notification_deliveries = _shared_notification(
+                targets,
+                target=json.dumps(recipient_list),
+                html_message=options.pop('html_message', None),
+                payload=Payload.build(mail_body, options),
+                status=Notification.STATUS_PENDING,
+                priority=priority,
+            )
+            notifications.append(notification)
+            deliveries.extend(notification_deliveries)
         except Exception:
             logger.exception('error notifying %s', event.name)
-        count += targets.count()
+        count += len(targets)
 
-    return count
+    return count - _store(event, coalesce.schedule(event, notifications), deliveries)
 
 
 def notify(
@@ -116,43 +277,165 @@ def notify(
     additional_email_targets=None,
     attachments: Optional[list[Attachment]] = None,
     slack_attachments=None,
+    defer_template: Optional[bool] = None,
+    priority: Optional[int] = None,
+    dedup_key: Optional[str] = None,
+    dedup_ttl: Optional[int] = None,
 ) -> int:
-    if isinstance(message, blocks.Block):
-        # temporarily support both calls (eventually deprecate non-blocks and this method)
-        return __notify_blocks(event_name, message)
+    """
+    `priority` (models.Priority) defaults to the one of the event.
+    calls with the same `dedup_key` (for the same event) within `dedup_ttl` seconds (NOTIFICATIONS_DEDUP_TTL by
+    default) only notify the first time, returning 0 afterwards (see dedup.py)
+    """
+    with dedup.once(event_name, dedup_key, dedup_ttl) as first:
+        if not first:
+            return 0
 
-    count = 0
+        if isinstance(message, blocks.Block):
+            # temporarily support both calls (eventually deprecate non-blocks and this method)
+            return __notify_blocks(event_name, message, priority=priority)
 
-    if event_name is not None:
-        event = Event.objects.get(name=event_name)
-        if queryset is None:
-            queryset = event.subscription_set
-    elif queryset:
-        # enabled flag does not really matter here
-        event = queryset.first().event
-    else:
+        event, subscriptions = _get_subscriptions(event_name, queryset)
+        if event is None:
+            return 0
+
+        count, notifications, deliveries = _build_notifications(
+            event,
+            subscriptions,
+            message,
+            subject=subject,
+            html_message=html_message,
+            template=template,
+            context=context,
+            create_link=create_link,
+            additional_email_targets=additional_email_targets,
+            attachments=attachments,
+            slack_attachments=slack_attachments,
+            defer_template=defer_template,
+            priority=priority,
+        )
+        return count - _store(event, notifications, deliveries)
+
+
+async def anotify(event_name, message, dedup_key=None, dedup_ttl=None, **kwargs) -> int:
+    """
+    notify() for async code (plain text messages, no blocks nor queryset).
+    event and subscriptions come from the cache without leaving the event loop, notifications are built in it as well
+    and stored with a single thread hand-off so they are still written in one transaction
+    """
+    if dedup_key is not None and not await dedup.aclaim(event_name, dedup_key, dedup_ttl):
         return 0
+    try:
+        event, subscriptions = await cache.aget_event(event_name)
+        count, notifications, deliveries = _build_notifications(event, subscriptions, message, **kwargs)
+        count -= await sync_to_async(_store)(event, notifications, deliveries)
+    except BaseException:
+        if dedup_key is not None:
+            await dedup.arelease(event_name, dedup_key)
+        raise
+    return count
+
 
-    queryset = queryset.filter(enabled=True)
+def notify_batch(items) -> list[int]:
+    """
+    notify() each of `items` (dicts with `event_name` and `message`, optionally `subject`, `html_message`,
+    `priority` and `dedup_key`), storing all the notifications in a single transaction.
+    returns the number of notifications of each item, raises Event.DoesNotExist if any event does not exist
+    """
+    counts = []
+    built = []
+    claimed = []
+    try:
+        for item in items:
+            if item.get('dedup_key') is not None:
+                if not dedup.claim(item['event_name'], item['dedup_key']):
+                    counts.append(0)
+                    continue
+                claimed.append((item['event_name'], item['dedup_key']))
+            event, subscriptions = cache.get_event(item['event_name'])
+            count, item_notifications, item_deliveries = _build_notifications(
+                event,
+                subscriptions,
+                item['message'],
+                subject=item.get('subject'),
+                html_message=item.get('html_message'),
+                priority=item.get('priority'),
+            )
+            counts.append(count)
+            built.append((len(counts) - 1, event, item_notifications, item_deliveries))
+        # a single check for the subscriptions deleted meanwhile of all the items
+        deleted = _deleted_subscriptions(
+            [n for _, _, ns, _ in built for n in ns], [d for _, _, _, ds in built for d in ds]
+        )
+        notifications = []
+        deliveries = []
+        for i, event, item_notifications, item_deliveries in built:
+            item_notifications, item_deliveries, dropped = _without_deleted(
+                item_notifications, item_deliveries, deleted
+            )
+            if dropped:
+                cache.invalidate(event.name)
+                counts[i] -= dropped
+            notifications.extend(item_notifications)
+            deliveries.extend(item_deliveries)
+        _bulk_store(notifications, deliveries)
+    except BaseException:
+        for event_name, dedup_key in claimed:
+            dedup.release(event_name, dedup_key)
+        raise
+    return counts
+
+
+def _build_notifications(
+    event,
+    subscriptions,
+    message,
+    subject=None,
+    html_message=None,
+    template=None,
+    context=None,
+    create_link=False,
+    additional_email_targets=None,
+    attachments=None,
+    slack_attachments=None,
+    defer_template=None,
+    priority=None,
+):
+    """
+    build (unsaved) notifications and deliveries of notify() for `event` and its `subscriptions`
+    returns (count, notifications, deliveries)
+    """
+    count = 0
+    notifications = []
+    deliveries = []
+    priority = _priority(event, priority)
 
     slack_text = f'{subject}: {message}' if subject else message
     api_kwargs = event.slack_api_kwargs()
     if slack_attachments:
         # TODO: can this be taken from a more "generic" arg and also use it in email?
         api_kwargs['attachments'] = slack_attachments
-    for subscription in queryset.filter(service=Subscription.Service.SLACK):
+    targets = [s for s in subscriptions if s.service == Subscription.Service.SLACK]
+    payload = Payload.build(slack_text, api_kwargs) if targets else None
+    for subscription in targets:
         for target in subscription.target.split('\n'):
-            Notification.objects.create(
-                subscription=subscription, message=slack_text, target=target.strip(), options=json.dumps(api_kwargs)
+            notifications.append(
+                Notification(subscription=subscription, target=target.strip(), payload=payload, priority=priority)
             )
             count += 1
 
-    targets = queryset.filter(service=Subscription.Service.MAIL)
+    targets = [s for s in subscriptions if s.service == Subscription.Service.WEBHOOK]
+    if targets:
+        webhook_notifications = _webhook_notifications(
+            targets, Payload.build(message, {'subject': subject} if subject else None), priority
+        )
+        notifications.extend(webhook_notifications)
+        count += len(webhook_notifications)
+
+    targets = [s for s in subscriptions if s.service == Subscription.Service.MAIL]
     if targets:
         try:
-            recipient_list = {
-                mail.strip() for target in targets.values_list('target', flat=True) for mail in target.split('\n')
-            }
+            recipient_list = {mail.strip() for target in targets for mail in target.target.split('\n')}
 
             if additional_email_targets:
                 recipient_list.update(set(additional_email_targets))
@@ -164,11 +447,10 @@ def notify(
                 subject=subject,
                 from_email=event.mail_from or settings.NOTIFICATIONS_MAIL_FROM,
                 reply_to=[event.mail_reply_to] if event.mail_reply_to else None,
-                html_message=html_message,
                 attachments=attachments,
             )
 
-            prepare_and_store_notifications(
+            notification, notification_deliveries = prepare_notifications(
                 template=template,
                 event=event,
                 create_link=create_link,
@@ -177,15 +459,20 @@ def notify(
                 mail_options=mail_options,
                 targets=targets,
                 mail_body=mail_body,
+                html_message=html_message,
+                defer_template=defer_template,
+                priority=priority,
             )
+            notifications.append(notification)
+            deliveries.extend(notification_deliveries)
         except Exception:
             logger.exception('error notifying %s', event.name)
-        count += targets.count()
+        count += len(targets)
 
-    return count
+    return count, coalesce.schedule(event, notifications), deliveries
 
 
-def prepare_and_store_notifications(
+def prepare_notifications(
     template: str,
     event: Event,
     create_link: bool,
@@ -194,26 +481,65 @@ def prepare_and_store_notifications(
     mail_options: dict,
     targets: list,
     mail_body: str,
-) -> None:
-    if template:
-        template_message = get_templated_mail(
-            template_name=template,
-            context=context,
+    html_message: Optional[str] = None,
+    defer_template: Optional[bool] = None,
+    priority: Optional[int] = None,
+) -> tuple[Notification, list[Delivery]]:
+    """
+    build a single (unsaved) mail notification for all the `targets` subscriptions, and its deliveries.
+    `template` is rendered here or, if deferred (see rendering.defer_template), by notification_sender
+    """
+    if template and rendering.defer_template(defer_template, context):
+        mail_options.update(rendering.template_options(template, context, create_link))
+        # plain message (if any) until rendered
+        mail_body = mail_body or ''
+    elif template:
+        mail_options["subject"], mail_body, html_message = rendering.render_mail(
+            template,
+            context,
             from_email=event.mail_from or settings.NOTIFICATIONS_MAIL_FROM,
-            create_link=create_link,
             to=recipient_list,
+            create_link=create_link,
         )
-        mail_options["subject"] = template_message.subject
-        mail_body = template_message.body
-        for alt in template_message.alternatives:
-            if alt[1] == 'text/html':
-                mail_options["html_message"] = alt[0]
-                break
-    for target in targets:
-        Notification.objects.create(
-            subscription=target,
-            target=json.dumps(recipient_list),
-            message=mail_body,
-            options=json.dumps(mail_options),
-            status=Notification.STATUS_PENDING,
-        )
+    return _shared_notification(
+        targets,
+        # sorted: the same target whatever the process (set order), for coalescing
+        target=json.dumps(sorted(recipient_list)),
+        html_message=html_message,
+        payload=Payload.build(mail_body, mail_options),
+        status=Notification.STATUS_PENDING,
+        priority=_priority(event, priority),
+        next_attempt_at=coalesce.window_end(event),
+    )
+
+
+def prepare_and_store_notifications(
+    template: str,
+    event: Event,
+    create_link: bool,
+    recipient_list: list,
+    context: str,
+    mail_options: dict,
+    targets: list,
+    mail_body: str,
+    html_message: Optional[str] = None,
+    defer_template: Optional[bool] = None,
+    priority: Optional[int] = None,
+) -> None:
+    """
+    store the mail notification of prepare_notifications() (same arguments), a single one for all the `targets`
+    """
+    notification, deliveries = prepare_notifications(
+        template,
+        event,
+        create_link,
+        recipient_list,
+        context,
+        mail_options,
+        targets,
+        mail_body,
+        html_message=html_message,
+        defer_template=defer_template,
+        priority=priority,
+    )
+    _store(event, [notification], deliveries)
@@ -1,7 +1,38 @@
+import json
+
+from django.conf import settings
 from django.http.response import JsonResponse
+from django.utils.crypto import constant_time_compare
 from django.views.decorators.csrf import csrf_exempt
 
-from notifications import models, utils
+from notifications import cache, models, utils
+
+# request header with the dedup_key of notify() (retried requests with the same one only notify once)
+DEDUP_HEADER = 'Idempotency-Key'
+
+
+def _check(event_name, token, message):
+    """
+    validate a notification posted to the API (event, its token and message)
+    returns None if valid or (error, HTTP status)
+    """
+    if event_name is None:
+        return 'event not found', 404
+    try:
+        # token is checked against the cached event
+        ev, _ = cache.get_event(event_name)
+    except models.Event.DoesNotExist:
+        return 'event not found', 404
+    return _check_event(ev, token, message)
+
+
+def _check_event(ev, token, message):
+    if not ev.external_token or not constant_time_compare(ev.external_token, token or ''):
+        return 'invalid token', 403
+
+    if not message:
+        return 'missing message', 400
+    return None
 
 
 @csrf_exempt
@@ -9,25 +40,107 @@ def notify(request):
     if request.method != 'POST':
         return JsonResponse({'error': 'invalid method'}, status=400)
 
-    event = request.POST.get('event')
-    if event is None:
+    error = _check(request.POST.get('event'), request.POST.get('token'), request.POST.get('message'))
+    if error is not None:
+        return JsonResponse({'error': error[0]}, status=error[1])
+
+    c = utils.notify(
+        request.POST.get('event'),
+        request.POST.get('message'),
+        subject=request.POST.get('subject'),
+        html_message=request.POST.get('html_message'),
+        dedup_key=request.headers.get(DEDUP_HEADER),
+    )
+
+    return JsonResponse({'notifications': c}, status=200)
+
+
+async def anotify(request):
+    """
+    same as notify, as an async view for ASGI deployments: requests are handled in the event loop, only storing the
+    notifications is handed off to a thread (event lookup is usually a cache hit)
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'invalid method'}, status=400)
+
+    event_name = request.POST.get('event')
+    if event_name is None:
         return JsonResponse({'error': 'event not found'}, status=404)
     try:
-        ev = models.Event.objects.get(name=event)
+        ev, _ = await cache.aget_event(event_name)
     except models.Event.DoesNotExist:
         return JsonResponse({'error': 'event not found'}, status=404)
 
-    if not ev.external_token or ev.external_token != request.POST.get('token'):
-        return JsonResponse({'error': 'invalid token'}, status=403)
-
-    if not request.POST.get('message'):
-        return JsonResponse({'error': 'missing message'}, status=400)
+    error = _check_event(ev, request.POST.get('token'), request.POST.get('message'))
+    if error is not None:
+        return JsonResponse({'error': error[0]}, status=error[1])
 
-    c = utils.notify(
+    c = await utils.anotify(
         ev.name,
         request.POST.get('message'),
         subject=request.POST.get('subject'),
         html_message=request.POST.get('html_message'),
+        dedup_key=request.headers.get(DEDUP_HEADER),
     )
 
     return JsonResponse({'notifications': c}, status=200)
+
+
+# csrf_exempt decorator only supports async views since Django 5.0
+anotify.csrf_exempt = True
+
+
+@csrf_exempt
+def notify_batch(request):
+    """
+    JSON list of notifications ({event, token, message, subject, html_message, dedup_key}), all stored in one
+    transaction.
+    replies with a list of results in the same order: {"notifications": count} or {"error": reason, "status": code}
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'invalid method'}, status=400)
+
+    try:
+        items = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({'error': 'invalid JSON'}, status=400)
+    if not isinstance(items, list):
+        return JsonResponse({'error': 'expected a list of notifications'}, status=400)
+    if len(items) > settings.NOTIFICATIONS_API_BATCH_MAX_SIZE:
+        return JsonResponse(
+            {'error': f'too many notifications (max {settings.NOTIFICATIONS_API_BATCH_MAX_SIZE})'}, status=400
+        )
+
+    results = []
+    valid = []
+    for item in items:
+        if not isinstance(item, dict) or not all(
+            isinstance(item.get(k), (str, type(None)))
+            for k in ('event', 'token', 'message', 'subject', 'html_message', 'dedup_key')
+        ):
+            error = ('invalid notification', 400)
+        else:
+            error = _check(item.get('event'), item.get('token'), item.get('message'))
+        if error is not None:
+            results.append({'error': error[0], 'status': error[1]})
+            continue
+        result = {}
+        results.append(result)
+        valid.append(
+            (
+                result,
+                {
+                    'event_name': item['event'],
+                    'message': item['message'],
+                    'subject': item.get('subject'),
+                    'html_message': item.get('html_message'),
+                    'dedup_key': item.get('dedup_key'),
+                },
+            )
+        )
+
+    counts = utils.notify_batch([item for _, item in valid])
+    for (result, _), count in zip(valid, counts):
+        result['notifications'] = count
+
+    return JsonResponse(results, status=200, safe=False)
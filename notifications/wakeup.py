@@ -0,0 +1,135 @@
+import logging
+import select
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from notifications.models import Notification
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'notifications_pending'
+
+
+def get_wakeup():
+    """
+    wakeup strategy used by notification_sender while idle, from NOTIFICATIONS_SENDER_WAKEUP
+    (default picks PostgresWakeup on PostgreSQL and PollWakeup for any other database)
+    """
+    if settings.NOTIFICATIONS_SENDER_WAKEUP:
+        return import_string(settings.NOTIFICATIONS_SENDER_WAKEUP)()
+    if connection.vendor == 'postgresql':
+        return PostgresWakeup()
+    return PollWakeup()
+
+
+def notify_pending():
+    """
+    wake up idle senders: new pending notifications were created
+    on PostgreSQL the NOTIFY is only delivered once (and if) the current transaction commits
+    """
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute(f'NOTIFY {CHANNEL}')
+
+
+@receiver(post_save, sender=Notification)
+def _notification_saved(sender, instance, created, raw=False, **kwargs):
+    # bulk_create does not send post_save, notify() takes care of those
+    if not raw and instance.status == Notification.STATUS_PENDING:
+        notify_pending()
+
+
+class PollWakeup:
+    """
+    sleep between ticks while idle: NOTIFICATIONS_SENDER_POLL_MIN seconds after a busy tick,
+    doubling for each idle tick up to NOTIFICATIONS_SENDER_POLL_MAX
+    """
+
+    def __init__(self):
+        self.min_interval = settings.NOTIFICATIONS_SENDER_POLL_MIN
+        self.max_interval = settings.NOTIFICATIONS_SENDER_POLL_MAX
+        self.interval = self.min_interval
+
+    def wait(self, busy):
+        """
+        called after each tick that did not fill a batch, `busy` is whether it processed anything
+        """
+        if busy:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        self.sleep(self.interval)
+
+    def sleep(self, timeout):
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+
+class PostgresWakeup(PollWakeup):
+    """
+    LISTEN for notify_pending() so new notifications are picked up straight away (including the ones received
+    while the last tick ran, it does not wait at all then).
+    it still wakes up every NOTIFICATIONS_SENDER_POLL_MAX seconds at most, for expired claims and deferred rows
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._listening = None
+        # psycopg 3: notifications received by the queries of the sender (see _notified)
+        self._notified_meanwhile = False
+
+    def wait(self, busy):
+        self.sleep(self.max_interval)
+
+    def _listen(self):
+        connection.ensure_connection()
+        if self._listening is not connection.connection:
+            # (re)connected
+            with connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL}')
+            self._listening = connection.connection
+            if not hasattr(self._listening, 'poll'):
+                # psycopg 3 hands the ones received while running other queries to its handlers only
+                self._listening.add_notify_handler(self._notified)
+        return connection.connection
+
+    def _notified(self, notify):
+        self._notified_meanwhile = True
+
+    def sleep(self, timeout):
+        try:
+            conn = self._listen()
+            if hasattr(conn, 'poll'):
+                # psycopg2: the ones received by other queries are already in conn.notifies, poll() reads the rest
+                # (without blocking)
+                conn.poll()
+                if not conn.notifies and select.select([conn], [], [], timeout)[0]:
+                    conn.poll()
+                conn.notifies.clear()
+            elif self._notified_meanwhile:
+                self._notified_meanwhile = False
+            elif select.select([conn.fileno()], [], [], timeout)[0]:
+                # psycopg 3 (notifies() has no timeout before 3.2): only read once something arrived
+                notifies = conn.notifies()
+                try:
+                    next(notifies, None)
+                finally:
+                    notifies.close()
+                self._notified_meanwhile = False
+        except Exception:
+            logger.exception('failed to wait for notifications, polling instead')
+            self._listening = None
+            time.sleep(self.min_interval)
+
+    def close(self):
+        if self._listening is not None and self._listening is connection.connection:
+            with connection.cursor() as cursor:
+                cursor.execute(f'UNLISTEN {CHANNEL}')
+        self._listening = None
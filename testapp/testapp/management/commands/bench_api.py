@@ -0,0 +1,63 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.test import AsyncClient, Client, override_settings
+from django.urls import reverse
+
+from notifications import models
+
+
+class Command(BaseCommand):
+    help = (
+        'Testapp command to compare requests per second of the notify API through the WSGI and ASGI handlers '
+        '(in-process, no network or server involved)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='Requests per run')
+        parser.add_argument('--concurrency', type=int, default=20, help='Concurrent requests (threads for WSGI)')
+
+    def handle(self, *args, **options):
+        # committed, WSGI requests are made from other threads (and database connections)
+        e = models.Event.objects.create(name='bench_api', external_token='bench')
+        e.subscription_set.create(service=models.Subscription.Service.SLACK, target='#bench')
+        self.data = {'event': e.name, 'token': 'bench', 'message': 'bench_api'}
+        try:
+            self.stdout.write(f'{"handler":>20} {"ok":>8} {"errors":>8} {"rps":>10}')
+            with override_settings(ALLOWED_HOSTS=['testserver']):
+                self.report('wsgi notify', self.run_wsgi(reverse('notifications:notify'), options))
+                self.report('asgi notify', asyncio.run(self.run_asgi(reverse('notifications:notify'), options)))
+                self.report('asgi anotify', asyncio.run(self.run_asgi(reverse('notifications:anotify'), options)))
+        finally:
+            # do not leave anything behind
+            models.Notification.objects.filter(subscription__event=e).delete()
+            models.Payload.objects.filter(message='bench_api', notification__isnull=True).delete()
+            e.delete()
+
+    def report(self, name, result):
+        statuses, elapsed = result
+        ok = statuses.count(200)
+        self.stdout.write(f'{name:>20} {ok:>8} {len(statuses) - ok:>8} {len(statuses) / elapsed:>10.1f}')
+
+    def run_wsgi(self, url, options):
+        def post(_):
+            return Client().post(url, self.data).status_code
+
+        with ThreadPoolExecutor(options['concurrency']) as pool:
+            start = time.perf_counter()
+            statuses = list(pool.map(post, range(options['requests'])))
+            return statuses, time.perf_counter() - start
+
+    async def run_asgi(self, url, options):
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        client = AsyncClient()
+
+        async def post():
+            async with semaphore:
+                return (await client.post(url, self.data)).status_code
+
+        start = time.perf_counter()
+        statuses = await asyncio.gather(*(post() for _ in range(options['requests'])))
+        return list(statuses), time.perf_counter() - start
@@ -0,0 +1,62 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from notifications import models
+from notifications.management.commands import notification_sender
+
+
+class Command(BaseCommand):
+    help = 'Testapp command to measure how long notification_sender takes to pick up pending notifications'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help='Historical (sent) notifications')
+        parser.add_argument('--pending', type=int, default=100, help='Pending notifications')
+        parser.add_argument('--runs', type=int, default=20, help='Number of claims to measure')
+        parser.add_argument('--explain', action='store_true', help='Print query plan of the dequeue query')
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            e = models.Event.objects.create(name='bench_dequeue')
+            sub = e.subscription_set.create(service=models.Subscription.Service.SLACK, target='#bench')
+            chunk = 10_000
+            for i in range(0, options['rows'], chunk):
+                models.Notification.objects.bulk_create(
+                    models.Notification(
+                        subscription=sub, message='sent', target='#bench', status=models.Notification.STATUS_SENT
+                    )
+                    for _ in range(min(chunk, options['rows'] - i))
+                )
+            pending = models.Notification.objects.bulk_create(
+                models.Notification(subscription=sub, message='pending', target='#bench')
+                for _ in range(options['pending'])
+            )
+
+            cmd = notification_sender.Command()
+            timings = []
+            for _ in range(options['runs']):
+                start = time.perf_counter()
+                claimed = cmd.claim()
+                timings.append((time.perf_counter() - start) * 1000)
+                # release them for the next run
+                cmd.release(claimed)
+                cmd._cursors.clear()
+            timings.sort()
+            self.stdout.write(
+                f'claimed {len(claimed)} of {len(pending)} pending among {options["rows"]} rows - '
+                f'min {timings[0]:.2f}ms / median {timings[len(timings) // 2]:.2f}ms / max {timings[-1]:.2f}ms'
+            )
+
+            if options['explain']:
+                qs = (
+                    models.Notification.objects.filter(
+                        status=models.Notification.STATUS_PENDING, priority=models.Priority.NORMAL
+                    )
+                    .order_by('time', 'pk')
+                    .values_list('time', 'pk')[: cmd.batch_size]
+                )
+                self.stdout.write(qs.explain())
+            self.stdout.write(f'database: {connection.vendor}')
+            # do not leave anything behind
+            transaction.set_rollback(True)
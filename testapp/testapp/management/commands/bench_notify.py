@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from notifications import utils, models
+
+
+class Command(BaseCommand):
+    help = 'Testapp command to measure queries (and time) spent by notify() as the number of targets grows'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'targets', type=int, nargs='*', default=[1, 10, 100, 1000], help='Number of slack targets to test with'
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{"targets":>10} {"queries":>10} {"ms":>10}')
+        for n in options['targets']:
+            with transaction.atomic():
+                e = models.Event.objects.create(name=f'bench_notify_{n}')
+                e.subscription_set.create(
+                    service=models.Subscription.Service.SLACK, target='\n'.join(f'#channel{i}' for i in range(n))
+                )
+                with CaptureQueriesContext(connection) as ctx:
+                    start = time.perf_counter()
+                    utils.notify(e.name, 'benchmark')
+                    elapsed = (time.perf_counter() - start) * 1000
+                self.stdout.write(f'{n:>10} {len(ctx):>10} {elapsed:>10.1f}')
+                # do not leave anything behind
+                transaction.set_rollback(True)
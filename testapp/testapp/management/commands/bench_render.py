@@ -0,0 +1,66 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from templated_email import get_templated_mail
+
+from notifications import rendering
+
+
+class Command(BaseCommand):
+    help = 'Testapp command to measure templated mail renders per second, with and without the rendering caches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--template', default='random', help='Template to render')
+        parser.add_argument('--renders', type=int, default=2000, help='Renders per run')
+        parser.add_argument(
+            '--uncached-loaders',
+            action='store_true',
+            help='Use template loaders without their own cache (the default ones cache compiled templates)',
+        )
+
+    def handle(self, *args, **options):
+        if not options['uncached_loaders']:
+            return self.run(options)
+        templates = [
+            {
+                **settings.TEMPLATES[0],
+                'APP_DIRS': False,
+                'OPTIONS': {
+                    **settings.TEMPLATES[0].get('OPTIONS', {}),
+                    'loaders': [
+                        'django.template.loaders.filesystem.Loader',
+                        'django.template.loaders.app_directories.Loader',
+                    ],
+                },
+            }
+        ]
+        with override_settings(TEMPLATES=templates):
+            self.run(options)
+
+    def run(self, options):
+        template = options['template']
+        renders = options['renders']
+
+        def same_context(i):
+            return {'target': 'example.com', 'status': 'down'}
+
+        def other_context(i):
+            return {'target': f'example{i}.com', 'status': 'down'}
+
+        runs = [
+            ('get_templated_mail', lambda i: get_templated_mail(template, other_context(i))),
+            ('cached template', lambda i: rendering.render_mail(template, other_context(i))),
+            ('memoized render', lambda i: rendering.render_mail(template, same_context(i))),
+        ]
+        self.stdout.write(f'{"run":>20} {"renders/s":>12}')
+        for name, render in runs:
+            rendering.clear()
+            # warm up
+            render(-1)
+            start = time.perf_counter()
+            for i in range(renders):
+                render(i)
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f'{name:>20} {renders / elapsed:>12.1f}')
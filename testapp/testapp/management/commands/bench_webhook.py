@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from notifications import backends, models
+from tests import http_server
+
+
+class CloseHandler(http_server.JSONHandler):
+    # HTTP/1.0: connection closed after each response, no keep-alive
+    protocol_version = 'HTTP/1.0'
+
+
+class Command(BaseCommand):
+    help = (
+        'Testapp command to measure webhook deliveries per second against a local HTTP server, '
+        'with keep-alive (pooled) connections and with a new connection per request'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Notifications per run')
+        parser.add_argument('--concurrency', type=int, default=8, help='Backend concurrency (threads)')
+        parser.add_argument('--max-per-host', type=int, default=4, help='Concurrent requests per host')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{"connections":>24} {"concurrency":>12} {"opened":>8} {"errors":>8} {"req/s":>10}')
+        for name, handler in (('keep-alive (pooled)', http_server.JSONHandler), ('one per request', CloseHandler)):
+            for concurrency in sorted({1, options['concurrency']}):
+                self.run(name, handler, concurrency, options)
+
+    def run(self, name, handler, concurrency, options):
+        with http_server.LocalServer(lambda path, data: (200, {}, {'ok': True}), handler=handler) as server:
+            backend = backends.WebhookBackend(concurrency=concurrency, max_per_host=options['max_per_host'])
+            subscription = models.Subscription(event_id='bench_webhook', service=models.Subscription.Service.WEBHOOK)
+            notifications = []
+            for i in range(options['requests']):
+                # unsaved, no database involved
+                n = models.Notification(subscription=subscription, target=f'{server.url}hook')
+                n.content = (f'bench {i}', None)
+                notifications.append(n)
+            try:
+                start = time.perf_counter()
+                results = backend.send_batch(notifications)
+                elapsed = time.perf_counter() - start
+            finally:
+                backend.close()
+        errors = sum(1 for r in results if r is not None)
+        self.stdout.write(
+            f'{name:>24} {concurrency:>12} {backend.pool.opened:>8} {errors:>8} {len(results) / elapsed:>10.1f}'
+        )
@@ -0,0 +1,60 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    """
+    records every JSON request body in `server.requests` and replies with whatever `server.respond` returns
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, do not let keep-alive responses wait for delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        data = json.loads(body or 'null')
+        with self.server.lock:
+            self.server.requests.append((self.path, data))
+        status, headers, payload = self.server.respond(self.path, data)
+        payload = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer:
+    """
+    threaded HTTP server running in the background, to be used as a context manager
+    """
+
+    def __init__(self, respond, handler=JSONHandler):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.requests = []
+        self.httpd.lock = threading.Lock()
+        self.httpd.respond = respond
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.httpd.server_address
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -4,7 +4,7 @@ from slack_sdk.errors import SlackApiError
 from django.core import mail
 from django.test import TestCase, override_settings
 
-from notifications import models, blocks
+from notifications import models, blocks, rendering
 from notifications import utils
 from notifications.management.commands import notification_sender
 
@@ -19,7 +19,7 @@ class Test(TestCase):
 
     def setUp(self):
         super().setUp()
-        p = mock.patch('notifications.management.commands.notification_sender.WebClient')
+        p = mock.patch('notifications.backends.WebClient')
         self.sc_mock = p.start()
         self.sc_mock.return_value.chat_postMessage.return_value = {'ok': True}
         self.addCleanup(p.stop)
@@ -88,6 +88,45 @@ class Test(TestCase):
                 ),
             )
 
+    @override_settings(NOTIFICATIONS_DEFER_TEMPLATES=True)
+    def test_templated_deferred(self):
+        context = {'target': 'example.com', 'status': 'down'}
+        with mock.patch('notifications.rendering.render_mail', wraps=rendering.render_mail) as render:
+            utils.notify('test_event', 'dull version', template='random', context=context)
+            utils.notify('test_event', blocks.TemplatedMail('dull version', 'random', context))
+            # explicitly not deferred
+            utils.notify('test_event', blocks.TemplatedMail('dull version', 'random', context, defer=False))
+            self.assertEqual(render.call_count, 1)
+            # context that cannot be stored is rendered straight away
+            utils.notify(
+                'test_event',
+                'dull version',
+                template='random',
+                context={'target': models.Event(name='example.com'), 'status': 'down'},
+            )
+            self.assertEqual(render.call_count, 2)
+
+            n = models.Notification.objects.filter(subscription=self.sub2).first()
+            self.assertEqual(n.options_dict['template'], {'name': 'random', 'context': context, 'create_link': False})
+            self.assertIsNone(n.html_message)
+
+            self.cmd.handle_tick()
+            self.assertEqual(render.call_count, 4)
+
+        self.assertEqual(
+            models.Notification.objects.filter(subscription=self.sub2, status=models.Notification.STATUS_SENT).count(),
+            4,
+        )
+        self.assertEqual(len(mail.outbox), 4)
+        for m in mail.outbox:
+            self.assertEqual(m.from_email, 'not.surface@betfair.com')
+            self.assertEqual(m.subject, 'example.com status')
+            self.assertEqual(m.body, 'example.com is down\n\n')
+            self.assertEqual(
+                m.alternatives[0][0], '\n<!doctype html>\n<html>\n<body>\nexample.com is down\n</body>\n</html>\n'
+            )
+            self.assertEqual(m.to, ['at@mail.com'])
+
     def test_message_blocks(self):
         list1 = ['apple']
         list2 = ['fiat', 'tesla']
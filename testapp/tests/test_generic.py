@@ -1,11 +1,17 @@
+import json
 from unittest import mock
 
 from django.core import mail
+from django.core.cache import caches
+from django.db import connection
+from django.db.migrations.loader import MigrationLoader
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.admin.sites import AdminSite
+from django.contrib.auth.models import User
 from django.urls import reverse
 
-from notifications import models, utils, admin
+from notifications import admin, blocks, cache, models, operations, utils
 
 
 class Test(TestCase):
@@ -16,13 +22,13 @@ class Test(TestCase):
         self.assertEqual(utils.notify('test_event', 'Hello World!'), 1)
         self.assertEqual(models.Notification.objects.count(), 1)
         n = models.Notification.objects.first()
-        self.assertEqual(n.message, 'Hello World!')
+        self.assertEqual(n.message_text, 'Hello World!')
         self.assertEqual(n.status, models.Notification.STATUS_PENDING)
 
         self.assertEqual(utils.notify('test_event', 'Bye World...'), 1)
         self.assertEqual(models.Notification.objects.count(), 2)
         n = models.Notification.objects.last()
-        self.assertEqual(n.message, 'Bye World...')
+        self.assertEqual(n.message_text, 'Bye World...')
         self.assertEqual(n.status, models.Notification.STATUS_PENDING)
 
     @override_settings(NOTIFICATIONS_MAIL_FROM='some@mail.com')
@@ -32,6 +38,51 @@ class Test(TestCase):
         models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='b@a.com')
         self.assertEqual(utils.notify('test_event', 'Hello World!'), 2)
         self.assertEqual(len(mail.outbox), 0)
+        # single notification (email) for both subscriptions
+        n = models.Notification.objects.get()
+        # sorted, the same in any process (to be coalesced)
+        self.assertEqual(n.target, json.dumps(['a@a.com', 'b@a.com']))
+        self.assertEqual(sorted(n.delivery_set.values_list('subscription__target', flat=True)), ['a@a.com', 'b@a.com'])
+
+    @override_settings(NOTIFICATIONS_MAIL_FROM='some@mail.com')
+    def test_prepare_and_store_notifications(self):
+        e = models.Event.objects.create(name='test_event')
+        targets = [
+            models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target=target)
+            for target in ('b@a.com', 'a@a.com')
+        ]
+        # positional arguments, as it always took
+        utils.prepare_and_store_notifications(
+            None, e, False, ['b@a.com', 'a@a.com'], None, {'subject': 'hi'}, targets, 'hello'
+        )
+        n = models.Notification.objects.get()
+        self.assertEqual(n.target, json.dumps(['a@a.com', 'b@a.com']))
+        self.assertEqual((n.message_text, n.options_dict['subject']), ('hello', 'hi'))
+        self.assertEqual(n.delivery_set.count(), 2)
+
+    @override_settings(NOTIFICATIONS_MAIL_FROM='some@mail.com')
+    def test_create_email_notification_blocks(self):
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='b@a.com\nc@a.com')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='a@a.com')
+        self.assertEqual(utils.notify('test_event', blocks.Message([blocks.Section('hello')])), 2)
+        n = models.Notification.objects.get()
+        self.assertEqual(n.target, json.dumps(['a@a.com', 'b@a.com', 'c@a.com']))
+
+    @override_settings(NOTIFICATIONS_MAIL_FROM='some@mail.com')
+    def test_create_email_notification_no_bulk_returning(self):
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='a@a.com')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='b@a.com')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@someone')
+        # backends that cannot return primary keys from bulk inserts (MySQL)
+        with mock.patch.object(
+            type(connection.features), 'can_return_rows_from_bulk_insert', new_callable=mock.PropertyMock
+        ) as feature:
+            feature.return_value = False
+            self.assertEqual(utils.notify('test_event', 'Hello World!'), 3)
+        self.assertEqual(models.Notification.objects.count(), 2)
+        self.assertEqual(models.Delivery.objects.count(), 2)
 
     def test_api_notify(self):
         e = models.Event.objects.create(name='test_event')
@@ -65,6 +116,149 @@ class Test(TestCase):
         self.assertJSONEqual(r.content, {'notifications': 1})
         self.assertEqual(len(mail.outbox), 0)
 
+    @override_settings(NOTIFICATIONS_CACHE_TIMEOUT=60)
+    async def test_api_anotify(self):
+        e = await models.Event.objects.acreate(name='test_event', external_token='123')
+        await models.Subscription.objects.acreate(event=e, service=models.Subscription.Service.MAIL, target='a@a.com')
+        await models.Subscription.objects.acreate(event=e, service=models.Subscription.Service.SLACK, target='#a\n#b')
+        url = reverse('notifications:anotify')
+
+        r = await self.async_client.get(url)
+        self.assertEqual(r.status_code, 400)
+        r = await self.async_client.post(url, {'event': 'some'})
+        self.assertEqual(r.status_code, 404)
+        r = await self.async_client.post(url, {'event': 'test_event', 'token': '321'})
+        self.assertEqual(r.status_code, 403)
+        r = await self.async_client.post(url, {'event': 'test_event', 'token': '123'})
+        self.assertEqual(r.status_code, 400)
+
+        r = await self.async_client.post(
+            url, {'event': 'test_event', 'token': '123', 'message': 'hello', 'html_message': '<b>hello</b>'}
+        )
+        self.assertEqual(r.status_code, 200)
+        self.assertJSONEqual(r.content, {'notifications': 3})
+        self.assertEqual(await models.Notification.objects.acount(), 3)
+        self.assertEqual(await models.Delivery.objects.acount(), 1)
+        n = await models.Notification.objects.aget(html_message__isnull=False)
+        self.assertEqual(n.html_message, '<b>hello</b>')
+
+        with override_settings(NOTIFICATIONS_CACHE='default'):
+            self.assertEqual(await utils.anotify('test_event', 'bye'), 3)
+            self.assertIsNotNone(await caches['default'].aget('notifications:event:test_event'))
+        with override_settings(NOTIFICATIONS_CACHE_TIMEOUT=0):
+            self.assertEqual(await utils.anotify('test_event', 'bye'), 3)
+            with self.assertRaises(models.Event.DoesNotExist):
+                await utils.anotify('missing', 'bye')
+        self.assertEqual(await models.Notification.objects.filter(payload__message='bye').acount(), 6)
+
+    @override_settings(NOTIFICATIONS_CACHE_TIMEOUT=60)
+    def test_api_notify_batch(self):
+        e = models.Event.objects.create(name='test_event', external_token='123')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='a@a.com')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='#a\n#b')
+        models.Event.objects.create(name='no_token')
+        url = reverse('notifications:notify_batch')
+
+        self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(self.client.post(url, 'not json', content_type='application/json').status_code, 400)
+        self.assertEqual(
+            self.client.post(url, {'event': 'test_event'}, content_type='application/json').status_code, 400
+        )
+        with override_settings(NOTIFICATIONS_API_BATCH_MAX_SIZE=1):
+            r = self.client.post(url, [{}, {}], content_type='application/json')
+            self.assertEqual(r.status_code, 400)
+
+        items = [
+            {'event': 'test_event', 'token': '123', 'message': 'hello', 'subject': 'hi'},
+            {'event': 'missing', 'token': '123', 'message': 'hello'},
+            {'event': 'test_event', 'token': '321', 'message': 'hello'},
+            {'event': 'no_token', 'token': '', 'message': 'hello'},
+            {'event': 'test_event', 'token': '123'},
+            {'event': 'test_event', 'token': '123', 'message': {'not': 'text'}},
+            'hello',
+            {'event': 'test_event', 'token': '123', 'message': 'bye', 'html_message': '<b>bye</b>'},
+        ]
+        # one (cached) lookup per event, a single check of deleted subscriptions + a single transaction with the
+        # inserts of all of them
+        with self.assertNumQueries(11):
+            r = self.client.post(url, items, content_type='application/json')
+        self.assertEqual(r.status_code, 200)
+        self.assertJSONEqual(
+            r.content,
+            [
+                {'notifications': 3},
+                {'error': 'event not found', 'status': 404},
+                {'error': 'invalid token', 'status': 403},
+                {'error': 'invalid token', 'status': 403},
+                {'error': 'missing message', 'status': 400},
+                {'error': 'invalid notification', 'status': 400},
+                {'error': 'invalid notification', 'status': 400},
+                {'notifications': 3},
+            ],
+        )
+        self.assertEqual(models.Notification.objects.count(), 6)
+        self.assertEqual(models.Notification.objects.filter(payload__message='bye').count(), 3)
+        self.assertEqual(models.Notification.objects.get(html_message__isnull=False).html_message, '<b>bye</b>')
+
+    def test_notify_dedup(self):
+        caches['default'].clear()
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='#a\n#b')
+        models.Event.objects.create(name='other_event').subscription_set.create(
+            service=models.Subscription.Service.SLACK, target='#a'
+        )
+        self.assertEqual(utils.notify('test_event', 'hello', dedup_key='k1'), 2)
+        # no queries at all for duplicates
+        with self.assertNumQueries(0):
+            self.assertEqual(utils.notify('test_event', 'hello', dedup_key='k1'), 0)
+            self.assertEqual(utils.notify('test_event', blocks.Basic('hello'), dedup_key='k1'), 0)
+        # keys are per event
+        self.assertEqual(utils.notify('other_event', 'hello', dedup_key='k1'), 1)
+        self.assertEqual(utils.notify('test_event', 'hello', dedup_key='k2'), 2)
+        self.assertEqual(utils.notify('test_event', 'hello'), 2)
+        self.assertEqual(models.Notification.objects.count(), 7)
+        # expired
+        self.assertEqual(utils.notify('test_event', 'hello', dedup_key='k3', dedup_ttl=0), 2)
+        self.assertEqual(utils.notify('test_event', 'hello', dedup_key='k3'), 2)
+        # failed calls can be retried
+        with mock.patch('notifications.utils._bulk_store', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                utils.notify('test_event', 'hello', dedup_key='k4')
+            with self.assertRaises(RuntimeError):
+                utils.notify_batch([{'event_name': 'test_event', 'message': 'hello', 'dedup_key': 'k5'}])
+        self.assertEqual(utils.notify('test_event', 'hello', dedup_key='k4'), 2)
+        self.assertEqual(
+            utils.notify_batch(
+                [
+                    {'event_name': 'test_event', 'message': 'hello', 'dedup_key': 'k5'},
+                    {'event_name': 'test_event', 'message': 'hello', 'dedup_key': 'k5'},
+                    {'event_name': 'test_event', 'message': 'hello', 'dedup_key': 'k1'},
+                ]
+            ),
+            [2, 0, 0],
+        )
+
+    def test_api_notify_dedup(self):
+        caches['default'].clear()
+        e = models.Event.objects.create(name='test_event', external_token='123')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='#a')
+        data = {'event': 'test_event', 'token': '123', 'message': 'hello'}
+        for url in (reverse('notifications:notify'), reverse('notifications:anotify')):
+            r = self.client.post(url, data, headers={'Idempotency-Key': url})
+            self.assertEqual(r.json(), {'notifications': 1})
+            r = self.client.post(url, data, headers={'Idempotency-Key': url})
+            self.assertEqual(r.json(), {'notifications': 0})
+        r = self.client.post(
+            reverse('notifications:notify_batch'),
+            [{**data, 'dedup_key': 'a'}, {**data, 'dedup_key': 'a'}, {**data, 'dedup_key': 1}],
+            content_type='application/json',
+        )
+        self.assertJSONEqual(
+            r.content,
+            [{'notifications': 1}, {'notifications': 0}, {'error': 'invalid notification', 'status': 400}],
+        )
+        self.assertEqual(models.Notification.objects.count(), 3)
+
     def test_api_notify_multiline(self):
         e = models.Event.objects.create(name='test_event', external_token='123')
         models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='a@a.com\nb@a.com')
@@ -95,6 +289,40 @@ class Test(TestCase):
             self.assertEqual(models.Notification.objects.count(), 2)
             self.assertEqual(len(mail.outbox), 0)
 
+    def test_notify_priority(self):
+        e = models.Event.objects.create(name='test_event', priority=models.Priority.HIGH)
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@a')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='a@mail.com')
+        # event default
+        utils.notify('test_event', 'hello')
+        self.assertEqual(
+            list(models.Notification.objects.values_list('priority', flat=True)), [models.Priority.HIGH] * 2
+        )
+        models.Notification.objects.all().delete()
+        utils.notify('test_event', 'hello', priority=models.Priority.LOW)
+        utils.notify('test_event', blocks.Basic('hello'), priority=models.Priority.LOW)
+        self.assertEqual(
+            list(models.Notification.objects.values_list('priority', flat=True)), [models.Priority.LOW] * 4
+        )
+        with self.assertRaises(ValueError):
+            utils.notify('test_event', 'hello', priority=5)
+
+    def test_notify_html_message(self):
+        e = models.Event.objects.create(name='test_event', slack_username='bot')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@someone')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='at@mail.com')
+        self.assertEqual(utils.notify('test_event', 'hello', subject='hi', html_message='<b>hello</b>'), 2)
+
+        n = models.Notification.objects.get(target='@someone')
+        self.assertEqual(n.options_dict['username'], 'bot')
+        self.assertIsNone(n.html_message)
+        n = models.Notification.objects.exclude(target='@someone').get()
+        self.assertEqual(n.html_message, '<b>hello</b>')
+        self.assertEqual(n.options_dict['subject'], 'hi')
+        self.assertNotIn('html_message', n.options_dict)
+        # options can be filtered on
+        self.assertEqual(models.Notification.objects.filter(payload__options__username='bot').count(), 1)
+
     def test_api_notify_disabled_subscription(self):
         e = models.Event.objects.create(name='test_event', external_token='123')
         s = models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='f@b.com')
@@ -123,9 +351,27 @@ class Test(TestCase):
         m._messages.add.assert_called_with(20, '1 notifications created', '')
         self.assertEqual(models.Notification.objects.count(), 1)
         n = models.Notification.objects.first()
-        self.assertEqual(n.message, 'Test notification')
+        self.assertEqual(n.message_text, 'Test notification')
         self.assertEqual(n.status, models.Notification.STATUS_PENDING)
 
+    def test_admin_preview(self):
+        e = models.Event.objects.create(name='test_event')
+        for service, target in (('S', '@someone'), ('M', 'a@a.com'), ('W', 'https://hooks.example.com/x')):
+            models.Subscription.objects.create(event=e, service=service, target=target)
+        utils.notify('test_event', 'hello', subject='hi')
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@a.com', 'pass'))
+
+        def preview(n):
+            return self.client.get(reverse('admin:notifications_notification_preview', args=[n.pk]))
+
+        for n in models.Notification.objects.all():
+            self.assertEqual(preview(n).status_code, 200)
+        r = preview(models.Notification.objects.get(subscription__service='W'))
+        self.assertContains(r, 'POST https://hooks.example.com/x')
+        self.assertContains(r, '&quot;text&quot;: &quot;hello&quot;')
+        models.Subscription.objects.filter(service='W').delete()
+        self.assertEqual(preview(models.Notification.objects.get(subscription=None)).status_code, 404)
+
     @mock.patch('slack_sdk.WebClient.chat_postMessage', return_value={'ok': True})
     def test_admin_target_validation(self, slack_mock):
         e1 = models.Event.objects.create(name='test_event')
@@ -148,3 +394,187 @@ class Test(TestCase):
         slack_mock.assert_called_once_with(
             as_user=1, channel='@otherone', text=':mega:  This channel just subscribed event *test_event* :newspaper:'
         )
+
+    @override_settings(NOTIFICATIONS_CACHE_TIMEOUT=0)
+    def test_notify_bulk_insert(self):
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@someone')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='a@a.com')
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(utils.notify('test_event', 'hello'), 2)
+        base_queries = len(ctx)
+
+        models.Subscription.objects.create(
+            event=e, service=models.Subscription.Service.SLACK, target='\n'.join(f'#channel{i}' for i in range(50))
+        )
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='b@a.com')
+        # more targets do not mean more queries
+        with self.assertNumQueries(base_queries):
+            self.assertEqual(utils.notify('test_event', 'hello'), 53)
+        # one (shared) notification for both mail subscriptions
+        self.assertEqual(models.Notification.objects.count(), 54)
+
+        # unless they exceed batch size
+        with override_settings(NOTIFICATIONS_BULK_BATCH_SIZE=10):
+            with self.assertNumQueries(base_queries + 5):
+                self.assertEqual(utils.notify('test_event', 'hello'), 53)
+        self.assertEqual(models.Notification.objects.count(), 106)
+
+    def test_notify_payloads(self):
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='#a\n#b')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='#c')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='a@a.com')
+        self.assertEqual(utils.notify('test_event', 'hello'), 4)
+        self.assertEqual(utils.notify('test_event', 'hello'), 4)
+        # one payload for all slack notifications and another for mail, reused by the second call
+        self.assertEqual(models.Notification.objects.count(), 8)
+        self.assertEqual(models.Payload.objects.count(), 2)
+        self.assertEqual(models.Notification.objects.filter(message='', options__isnull=True).count(), 8)
+        self.assertEqual(utils.notify('test_event', 'bye'), 4)
+        self.assertEqual(models.Payload.objects.count(), 4)
+
+        # payloads are read through the cache
+        cache._payloads.clear()
+        notifications = list(models.Notification.objects.all())
+        with self.assertNumQueries(1):
+            cache.get_payloads({n.payload_id for n in notifications})
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                sorted({n.message_text for n in notifications}),
+                ['bye', 'hello'],
+            )
+        with override_settings(NOTIFICATIONS_PAYLOAD_CACHE_SIZE=1):
+            cache.get_payloads({n.payload_id for n in notifications})
+            self.assertEqual(len(cache._payloads), 1)
+        with self.assertRaises(models.Payload.DoesNotExist):
+            cache.get_payload('missing')
+
+    @override_settings(NOTIFICATIONS_CACHE_TIMEOUT=60)
+    def test_notify_cache(self):
+        e = models.Event.objects.create(name='test_event')
+        s = models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@someone')
+        self.assertEqual(utils.notify('test_event', 'hello'), 1)
+        # event and subscriptions cached, only the check for deleted subscriptions and the inserts (and the savepoint)
+        with self.assertNumQueries(5):
+            self.assertEqual(utils.notify('test_event', 'hello'), 1)
+
+        # subscription changes are picked up
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='a@a.com')
+        self.assertEqual(utils.notify('test_event', 'hello'), 2)
+        s.enabled = False
+        s.save()
+        self.assertEqual(utils.notify('test_event', 'hello'), 1)
+        # and event changes
+        e.slack_username = 'bot'
+        e.save()
+        s.enabled = True
+        s.save()
+        utils.notify('test_event', 'hello')
+        self.assertEqual(models.Notification.objects.last().message_text, 'hello')
+        self.assertEqual(models.Notification.objects.filter(target='@someone').last().options_dict['username'], 'bot')
+
+        # subscriptions moving between events invalidate both
+        e2 = models.Event.objects.create(name='other_event')
+        self.assertEqual(utils.notify('other_event', 'hello'), 0)
+        s.event = e2
+        s.save()
+        self.assertEqual(utils.notify('other_event', 'hello'), 1)
+        self.assertEqual(utils.notify('test_event', 'hello'), 1)
+
+        e.delete()
+        with self.assertRaises(models.Event.DoesNotExist):
+            utils.notify('test_event', 'hello')
+
+    @override_settings(NOTIFICATIONS_CACHE_TIMEOUT=60)
+    def test_notify_cache_deleted_subscriptions(self):
+        e = models.Event.objects.create(name='test_event')
+        slack = models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='#a')
+        mail = models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='a@a.com')
+        other = models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='b@a.com')
+        self.assertEqual(utils.notify('test_event', 'hello'), 3)
+        self.assertEqual(utils.notify_batch([{'event_name': 'test_event', 'message': 'hello'}]), [3])
+
+        def delete(*subscriptions):
+            # as another process would (no signals, cached entry left as it is)
+            pks = [s.pk for s in subscriptions]
+            models.Delivery.objects.filter(subscription__in=pks)._raw_delete('default')
+            models.Notification.objects.all()._raw_delete('default')
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'DELETE FROM {models.Subscription._meta.db_table} WHERE id IN ({", ".join(["%s"] * len(pks))})',
+                    pks,
+                )
+
+        delete(slack, mail)
+        self.assertIsNotNone(cache._local.get('notifications:event:test_event'))
+        # left out: the shared email goes to the subscription left
+        self.assertEqual(utils.notify('test_event', 'hello'), 1)
+        n = models.Notification.objects.get()
+        self.assertEqual(n.subscription, other)
+        self.assertEqual(list(n.delivery_set.values_list('subscription', flat=True)), [other.pk])
+        self.assertEqual(utils.notify('test_event', 'hello'), 1)
+
+        self.assertEqual(utils.notify_batch([{'event_name': 'test_event', 'message': 'hello'}]), [1])
+        delete(other)
+        self.assertEqual(utils.notify_batch([{'event_name': 'test_event', 'message': 'hello'}]), [0])
+        self.assertEqual(utils.notify('test_event', 'hello'), 0)
+        self.assertEqual(models.Notification.objects.count(), 0)
+
+    @override_settings(NOTIFICATIONS_CACHE='default', NOTIFICATIONS_CACHE_TIMEOUT=60)
+    def test_notify_shared_cache(self):
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@someone')
+        self.assertEqual(utils.notify('test_event', 'hello'), 1)
+        self.assertIsNotNone(caches['default'].get('notifications:event:test_event'))
+        with self.assertNumQueries(5):
+            self.assertEqual(utils.notify('test_event', 'hello'), 1)
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@other')
+        self.assertIsNone(caches['default'].get('notifications:event:test_event'))
+        self.assertEqual(utils.notify('test_event', 'hello'), 2)
+
+    @override_settings(NOTIFICATIONS_CACHE_TIMEOUT=0)
+    def test_notify_num_queries(self):
+        e = models.Event.objects.create(name='test_event')
+        with self.assertNumQueries(2):
+            # no subscriptions, event lookup
+            self.assertEqual(utils.notify('test_event', 'hello'), 0)
+
+        for i in range(5):
+            models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target=f'@u{i}')
+            models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target=f'{i}@a.com')
+            models.Subscription.objects.create(
+                event=e, service=models.Subscription.Service.MAIL, target=f'{i}@b.com', enabled=False
+            )
+            # single fetch for event and subscriptions + inserts (and savepoint), regardless of subscriptions
+            with self.assertNumQueries(6):
+                self.assertEqual(utils.notify('test_event', 'hello'), (i + 1) * 2)
+            with self.assertNumQueries(6):
+                self.assertEqual(utils.notify('test_event', blocks.Basic('hello')), (i + 1) * 2)
+            # queryset (admin): single fetch as well
+            with self.assertNumQueries(6):
+                self.assertEqual(utils.notify(None, 'hello', queryset=e.subscription_set.all()), (i + 1) * 2)
+
+    def test_index_operations_concurrently(self):
+        loader = MigrationLoader(connection)
+        before = loader.project_state(('notifications', '0010_payload'))
+        after = loader.project_state(('notifications', '0011_priority'))
+        migration = loader.get_migration('notifications', '0011_priority')
+        self.assertFalse(migration.atomic)
+        remove, add = migration.operations[-2:]
+        self.assertIsInstance(remove, operations.RemoveIndexConcurrently)
+        self.assertIsInstance(add, operations.AddIndexConcurrently)
+        schema_editor = mock.Mock()
+        schema_editor.connection.vendor = 'postgresql'
+        schema_editor.connection.alias = 'default'
+        remove.database_forwards('notifications', schema_editor, before, before)
+        add.database_forwards('notifications', schema_editor, before, after)
+        add.database_backwards('notifications', schema_editor, after, before)
+        self.assertEqual(
+            [(c[0], c.args[1].name, c.kwargs) for c in schema_editor.method_calls],
+            [
+                ('remove_index', 'notifications_pending_idx', {'concurrently': True}),
+                ('add_index', 'notifications_pending_idx', {'concurrently': True}),
+                ('remove_index', 'notifications_pending_idx', {'concurrently': True}),
+            ],
+        )
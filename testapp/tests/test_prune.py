@@ -0,0 +1,134 @@
+import datetime
+import gzip
+import json
+import tempfile
+from io import StringIO
+from pathlib import Path
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from notifications import models, utils
+
+
+@override_settings(
+    NOTIFICATIONS_MAIL_FROM='some@mail.com',
+    NOTIFICATIONS_RETENTION={'default': {'sent': 10, 'error': 20}, 'noisy_event': {'sent': 1, 'error': None}},
+)
+class Test(TestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ('test_event', 'noisy_event'):
+            e = models.Event.objects.create(name=name)
+            models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@a')
+            models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='a@a.com')
+        now = timezone.now()
+        for days in (0, 5, 15, 25):
+            for name in ('test_event', 'noisy_event'):
+                for status in (models.Notification.STATUS_PENDING, models.Notification.STATUS_SENT):
+                    utils.notify(name, f'{days} days ago')
+                    models.Notification.objects.filter(time__gt=now).update(
+                        time=now - datetime.timedelta(days=days), status=status
+                    )
+                utils.notify(name, f'{days} days ago')
+                models.Notification.objects.filter(time__gt=now).update(
+                    time=now - datetime.timedelta(days=days), status=models.Notification.STATUS_ERROR
+                )
+
+    def remaining(self, event, status):
+        return sorted(
+            models.Notification.objects.filter(subscription__event=event, status=status)
+            .values_list('payload__message', flat=True)
+            .distinct()
+        )
+
+    def test_prune(self):
+        total = models.Notification.objects.count()
+        out = StringIO()
+        call_command('notification_prune', dry_run=True, stdout=out)
+        self.assertIn('12 notifications to delete', out.getvalue())
+        self.assertEqual(models.Notification.objects.count(), total)
+
+        out = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('notification_prune', chunk_size=3, stdout=out)
+        self.assertIn('12 notifications deleted', out.getvalue())
+        # chunks walk the primary key from the last one deleted, rows to delete are never sorted by time
+        chunks = [
+            q['sql']
+            for q in queries
+            if q['sql'].startswith('SELECT "notifications_notification"."id" FROM') and 'LIMIT' in q['sql']
+        ]
+        self.assertGreater(len(chunks), 1)
+        self.assertFalse([sql for sql in chunks if '."time" ASC' in sql])
+        self.assertTrue(all('ORDER BY "notifications_notification"."id" ASC' in sql for sql in chunks))
+        self.assertEqual(models.Notification.objects.count(), total - 12)
+
+        # pending never pruned
+        self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_PENDING).count(), 16)
+        self.assertEqual(self.remaining('test_event', models.Notification.STATUS_SENT), ['0 days ago', '5 days ago'])
+        self.assertEqual(
+            self.remaining('test_event', models.Notification.STATUS_ERROR),
+            ['0 days ago', '15 days ago', '5 days ago'],
+        )
+        # per event rules
+        self.assertEqual(self.remaining('noisy_event', models.Notification.STATUS_SENT), ['0 days ago'])
+        self.assertEqual(len(self.remaining('noisy_event', models.Notification.STATUS_ERROR)), 4)
+        # deliveries of deleted notifications are gone too
+        self.assertFalse(models.Delivery.objects.filter(notification__isnull=True).exists())
+
+    def test_prune_payloads(self):
+        utils.notify('test_event', 'old')
+        models.Notification.objects.filter(payload__message='old').update(
+            time=timezone.now() - datetime.timedelta(days=30), status=models.Notification.STATUS_SENT
+        )
+        total = models.Payload.objects.count()
+
+        out = StringIO()
+        call_command('notification_prune', stdout=out)
+        # unused but recently created, notify() could still be reusing them
+        self.assertIn('unused payloads: 0', out.getvalue())
+        self.assertEqual(models.Payload.objects.count(), total)
+
+        models.Payload.objects.update(last_used=timezone.now() - datetime.timedelta(days=2))
+        out = StringIO()
+        call_command('notification_prune', dry_run=True, stdout=out)
+        self.assertIn('unused payloads: 2', out.getvalue())
+        call_command('notification_prune', chunk_size=1, stdout=out)
+        self.assertEqual(models.Payload.objects.count(), total - 2)
+        self.assertFalse(models.Payload.objects.filter(message='old').exists())
+
+    def test_prune_archive(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            call_command('notification_prune', archive=Path(tmp), stdout=StringIO())
+            files = list(Path(tmp).iterdir())
+            self.assertEqual(len(files), 1)
+            with gzip.open(files[0], 'rt') as f:
+                rows = [json.loads(line) for line in f]
+        self.assertEqual(len(rows), 12)
+        self.assertEqual(
+            sorted(rows[0]),
+            sorted(
+                [
+                    'id',
+                    'time',
+                    'subscription_id',
+                    'subscription__event_id',
+                    'subscription__service',
+                    'status',
+                    'target',
+                    'message',
+                    'options',
+                    'payload_id',
+                    'payload__message',
+                    'payload__options',
+                    'html_message',
+                    'attempts',
+                    'last_error',
+                ]
+            ),
+        )
+        self.assertFalse(models.Notification.objects.filter(pk__in=[r['id'] for r in rows]).exists())
@@ -0,0 +1,68 @@
+import os
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from templated_email import get_templated_mail
+
+from notifications import rendering
+
+
+class Test(TestCase):
+    def setUp(self):
+        super().setUp()
+        rendering.clear()
+        self.addCleanup(rendering.clear)
+
+    def test_render_mail(self):
+        context = {'target': 'example.com', 'status': 'down'}
+        expected = get_templated_mail('random', context)
+        self.assertEqual(
+            rendering.render_mail('random', context),
+            (expected.subject, expected.body, expected.alternatives[0][0]),
+        )
+
+    def test_render_cache(self):
+        context = {'target': 'example.com', 'status': 'down'}
+        with (
+            mock.patch('notifications.rendering.django_render_block', wraps=rendering.django_render_block) as render,
+            mock.patch(
+                'notifications.rendering.loader.select_template', wraps=rendering.loader.select_template
+            ) as load,
+        ):
+            first = rendering.render_mail('random', context)
+            # subject, html and plain blocks
+            self.assertEqual(render.call_count, 3)
+            self.assertEqual(rendering.render_mail('random', dict(context)), first)
+            self.assertEqual(render.call_count, 3)
+
+            # compiled template is reused for other contexts
+            self.assertEqual(rendering.render_mail('random', {'target': 'example.com', 'status': 'up'})[0], first[0])
+            self.assertEqual(render.call_count, 6)
+            self.assertEqual(load.call_count, 1)
+
+            with override_settings(NOTIFICATIONS_TEMPLATE_RENDER_CACHE_SIZE=0):
+                self.assertEqual(rendering.render_mail('random', context), first)
+                self.assertEqual(render.call_count, 9)
+            # contexts that cannot be compared are not memoized
+            rendering.render_mail('random', {'target': object()})
+            rendering.render_mail('random', {'target': object()})
+            self.assertEqual(render.call_count, 15)
+
+    def test_template_changed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'templated_email' / 'changing.email'
+            path.parent.mkdir()
+            path.write_text('{% block subject %}one{% endblock %}{% block plain %}{{ x }}{% endblock %}')
+            templates = [{'BACKEND': 'django.template.backends.django.DjangoTemplates', 'DIRS': [tmp]}]
+            with override_settings(TEMPLATES=templates):
+                self.assertEqual(rendering.render_mail('changing', {'x': 1})[:2], ('one', '1'))
+
+                path.write_text('{% block subject %}two{% endblock %}{% block plain %}{{ x }}{% endblock %}')
+                os.utime(path, (0, 0))
+                # cached unless DEBUG
+                self.assertEqual(rendering.render_mail('changing', {'x': 1})[:2], ('one', '1'))
+                with override_settings(DEBUG=True):
+                    self.assertEqual(rendering.render_mail('changing', {'x': 1})[:2], ('two', '1'))
+                    self.assertEqual(rendering.render_mail('changing', {'x': 2})[:2], ('two', '2'))
@@ -1,13 +1,24 @@
+import datetime
+import smtplib
+import threading
+import time
 from unittest import mock
 from slack_sdk.errors import SlackApiError
 
 from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.mail import get_connection
 from django.test import TestCase, override_settings
 from django.core.management import call_command
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from notifications import models
-from notifications import utils
+from notifications import backends, blocks, cache, models
+from notifications import retry, utils, wakeup
 from notifications.management.commands import notification_sender
+from . import http_server
 
 
 @override_settings(
@@ -16,7 +27,7 @@ from notifications.management.commands import notification_sender
 class SenderTest(TestCase):
     def setUp(self):
         super().setUp()
-        p = mock.patch('notifications.management.commands.notification_sender.WebClient')
+        p = mock.patch('notifications.backends.WebClient')
         self.sc_mock = p.start()
         self.addCleanup(p.stop)
 
@@ -56,6 +67,26 @@ class SenderTest(TestCase):
             username='NotTestBot',
         )
 
+    def test_single_email_per_event(self):
+        e = models.Event.objects.create(name='test_event')
+        subs = [
+            models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target=target)
+            for target in ('a@mail.com', 'b@mail.com\na@mail.com', 'c@mail.com')
+        ]
+        self.assertEqual(utils.notify('test_event', 'hello'), 3)
+        self.assertEqual(utils.notify('test_event', blocks.Basic('hello')), 3)
+        call_command('notification_sender', run_once=True)
+        # one email per notify, each recipient only once
+        self.assertEqual(len(mail.outbox), 2)
+        for m in mail.outbox:
+            self.assertEqual(sorted(m.to), ['a@mail.com', 'b@mail.com', 'c@mail.com'])
+        # still tracked per subscription
+        for sub in subs:
+            self.assertEqual(
+                list(sub.delivery_set.values_list('notification__status', flat=True)),
+                [models.Notification.STATUS_SENT] * 2,
+            )
+
     def test_handle_slack_random_error(self):
         self.sc_mock.return_value.chat_postMessage.side_effect = SlackApiError('none', {'error': 'random'})
         e = models.Event.objects.create(
@@ -72,6 +103,172 @@ class SenderTest(TestCase):
         self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_ERROR).count(), 1)
         self.sc_mock.return_value.chat_postMessage.assert_called_once()
 
+    @override_settings(NOTIFICATIONS_RETRY_POLICIES={'default': {'max_attempts': 3, 'backoff': 10, 'max_backoff': 15}})
+    def test_retry_transient_errors(self):
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='at@mail.com')
+        utils.notify('test_event', 'hello')
+        cmd = notification_sender.Command()
+        now = timezone.now()
+
+        with mock.patch.object(
+            EmailBackend, 'send_messages', side_effect=smtplib.SMTPResponseException(451, 'later')
+        ) as send_mock:
+            cmd.handle_tick()
+            n = models.Notification.objects.get()
+            self.assertEqual(n.status, models.Notification.STATUS_PENDING)
+            self.assertEqual(n.attempts, 1)
+            self.assertEqual(n.last_error, "SMTPResponseException: (451, 'later')")
+            # backoff with jitter
+            self.assertGreaterEqual(n.next_attempt_at, now + datetime.timedelta(seconds=5))
+            self.assertLessEqual(n.next_attempt_at, timezone.now() + datetime.timedelta(seconds=10))
+
+            # not retried before next_attempt_at
+            self.assertEqual(cmd.handle_tick(), 0)
+
+            for attempt, seconds in ((2, 20), (3, 60)):
+                with mock.patch('django.utils.timezone.now', return_value=now + datetime.timedelta(seconds=seconds)):
+                    self.assertEqual(cmd.handle_tick(), 1)
+                n.refresh_from_db()
+                self.assertEqual(n.attempts, attempt)
+            self.assertEqual(send_mock.call_count, 3)
+        # out of attempts
+        self.assertEqual(n.status, models.Notification.STATUS_DEAD)
+
+    def test_subscription_deleted(self):
+        self.sc_mock.return_value.chat_postMessage.return_value = {'ok': True}
+        e = models.Event.objects.create(name='test_event')
+        slack = models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@a')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@b')
+        mail_subs = [
+            models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target=target)
+            for target in ('a@mail.com', 'b@mail.com')
+        ]
+        utils.notify('test_event', 'hello')
+        utils.notify('test_event', 'bye')
+        slack.delete()
+        # first one of the shared mail notification (the one it is attached to)
+        mail_subs[0].delete()
+        call_command('notification_sender', run_once=True)
+        # slack @a, slack @b and the mail one (twice): sent to the recipients left
+        self.assertEqual(
+            list(models.Notification.objects.order_by('pk').values_list('status', flat=True)),
+            [models.Notification.STATUS_ERROR, models.Notification.STATUS_SENT, models.Notification.STATUS_SENT] * 2,
+        )
+        self.assertEqual(self.sc_mock.return_value.chat_postMessage.call_count, 2)
+        self.assertEqual([m.to for m in mail.outbox], [['b@mail.com'], ['b@mail.com']])
+        # who was notified is kept
+        self.assertEqual(
+            sorted(models.Delivery.objects.values_list('target', 'subscription')),
+            [
+                ('a@mail.com', None),
+                ('a@mail.com', None),
+                ('b@mail.com', mail_subs[1].pk),
+                ('b@mail.com', mail_subs[1].pk),
+            ],
+        )
+
+        # no subscription left at all
+        mail.outbox.clear()
+        utils.notify('test_event', 'hello again')
+        mail_subs[1].delete()
+        call_command('notification_sender', run_once=True)
+        self.assertEqual(models.Notification.objects.order_by('pk').last().status, models.Notification.STATUS_ERROR)
+        self.assertEqual(mail.outbox, [])
+
+    def test_merge_error(self):
+        self.sc_mock.return_value.chat_postMessage.return_value = {'ok': True}
+        e = models.Event.objects.create(name='test_event', coalesce_window=60)
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@a\n@b')
+        utils.notify('test_event', 'hello 1')
+        utils.notify('test_event', 'hello 2')
+        models.Notification.objects.update(next_attempt_at=timezone.now())
+        with mock.patch('notifications.coalesce.merge_slack', side_effect=[RuntimeError('bad'), ('x', {'blocks': []})]):
+            call_command('notification_sender', run_once=True)
+        # @a ones failed to be merged, @b ones were sent
+        self.assertEqual(
+            sorted(models.Notification.objects.values_list('target', 'status', 'attempts')),
+            [
+                ('@a', models.Notification.STATUS_ERROR, 1),
+                ('@a', models.Notification.STATUS_ERROR, 1),
+                ('@b', models.Notification.STATUS_SENT, 0),
+                ('@b', models.Notification.STATUS_SENT, 0),
+            ],
+        )
+        self.sc_mock.return_value.chat_postMessage.assert_called_once()
+
+    @override_settings(NOTIFICATIONS_PAYLOAD_CACHE_SIZE=0, NOTIFICATIONS_SLACK_CONCURRENCY=4)
+    def test_payloads_loaded_once(self):
+        self.sc_mock.return_value.chat_postMessage.return_value = {'ok': True}
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(
+            event=e, service=models.Subscription.Service.SLACK, target='\n'.join(f'#c{i}' for i in range(8))
+        )
+        utils.notify('test_event', 'hello')
+        utils.notify('test_event', 'bye')
+        threads = []
+
+        def created(sender, **kwargs):
+            threads.append(threading.current_thread().name)
+
+        connection_created.connect(created)
+        self.addCleanup(connection_created.disconnect, created)
+        cache._payloads.clear()
+        cmd = notification_sender.Command()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(cmd.handle_tick(), 16)
+        self.assertEqual(self.sc_mock.return_value.chat_postMessage.call_count, 16)
+        # a single query for the payloads, even without cache, and no database access from the backend threads
+        self.assertEqual(len([q for q in queries if 'notifications_payload' in q['sql']]), 1)
+        self.assertEqual(threads, [])
+
+    def test_permanent_errors(self):
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='at@mail.com')
+        utils.notify('test_event', 'hello')
+        with mock.patch.object(EmailBackend, 'send_messages', side_effect=smtplib.SMTPResponseException(550, 'no')):
+            call_command('notification_sender', run_once=True)
+        n = models.Notification.objects.get()
+        self.assertEqual(n.status, models.Notification.STATUS_ERROR)
+        self.assertEqual(n.attempts, 1)
+
+    def test_transient_smtp_errors(self):
+        self.assertTrue(retry.is_transient(smtplib.SMTPServerDisconnected('gone')))
+        self.assertTrue(retry.is_transient(smtplib.SMTPRecipientsRefused({'a@mail.com': (450, b'busy')})))
+        self.assertTrue(retry.is_transient(ConnectionResetError()))
+        # SMTPException are OSError too, but these are permanent
+        self.assertFalse(retry.is_transient(smtplib.SMTPRecipientsRefused({'a@mail.com': (550, b'unknown')})))
+        self.assertFalse(
+            retry.is_transient(
+                smtplib.SMTPRecipientsRefused({'a@mail.com': (450, b'busy'), 'b@mail.com': (550, b'unknown')})
+            )
+        )
+        self.assertFalse(retry.is_transient(smtplib.SMTPNotSupportedError('no SMTPUTF8')))
+        self.assertFalse(retry.is_transient(smtplib.SMTPException('other')))
+
+    @override_settings(NOTIFICATIONS_RETRY_POLICIES={'M': {'max_attempts': 2}})
+    def test_retry_policy_without_default(self):
+        # built-in default for the rest
+        self.assertEqual(retry.get_policy('M'), {'max_attempts': 2, 'backoff': 60, 'max_backoff': 3600})
+        self.assertEqual(retry.get_policy('S'), {'max_attempts': 5, 'backoff': 60, 'max_backoff': 3600})
+        self.assertIsNone(retry.next_delay('M', 2))
+        self.assertLessEqual(retry.next_delay('S', 1), 60)
+
+    def test_retry_slack_server_error(self):
+        self.sc_mock.return_value.chat_postMessage.side_effect = SlackApiError(
+            'none', mock.MagicMock(status_code=503, get=lambda x: None)
+        )
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@someone')
+        utils.notify('test_event', 'hello')
+        call_command('notification_sender', run_once=True)
+        n = models.Notification.objects.get()
+        self.assertEqual(n.status, models.Notification.STATUS_PENDING)
+        self.assertEqual(n.attempts, 1)
+        self.assertIsNotNone(n.next_attempt_at)
+        # claim released
+        self.assertIsNone(n.claimed_until)
+
     def test_handle_slack_rate_limit(self):
         cmd = notification_sender.Command()
         self.sc_mock.return_value.chat_postMessage.side_effect = SlackApiError(
@@ -102,13 +299,64 @@ class SenderTest(TestCase):
         self.sc_mock.return_value.chat_postMessage.assert_not_called()
         self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_PENDING).count(), 1)
 
-        with mock.patch('time.time', return_value=cmd._Command__slack_limited + 2):
+        # row is not even read again while waiting for retry-after (one select per priority)
+        with self.assertNumQueries(5):
+            cmd.handle_tick()
+
+        with (
+            mock.patch('time.time', return_value=time.time() + 8),
+            mock.patch('django.utils.timezone.now', return_value=timezone.now() + datetime.timedelta(seconds=8)),
+        ):
             self.sc_mock.return_value.chat_postMessage.side_effect = ['ok']
             cmd.handle_tick()
             # post retried, sent and status updated
             self.sc_mock.return_value.chat_postMessage.assert_called_once()
             self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_SENT).count(), 1)
 
+    def test_handle_slack_rate_limit_per_channel(self):
+        def post(channel, **_):
+            if channel == '#noisy':
+                raise SlackApiError(
+                    'none',
+                    mock.MagicMock(
+                        get=lambda x: 'ratelimited' if x == 'error' else None,
+                        headers={'retry-after': '30'},
+                    ),
+                )
+            return {'ok': True}
+
+        self.sc_mock.return_value.chat_postMessage.side_effect = post
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='#noisy\n#quiet')
+        cmd = notification_sender.Command()
+        self.assertEqual(utils.notify('test_event', 'hello'), 2)
+        cmd.handle_tick()
+        # rate limited channel does not block the other one
+        self.assertEqual(self.sc_mock.return_value.chat_postMessage.call_count, 2)
+        self.assertEqual(models.Notification.objects.get(target='#quiet').status, models.Notification.STATUS_SENT)
+        self.assertEqual(models.Notification.objects.get(target='#noisy').status, models.Notification.STATUS_PENDING)
+
+        self.sc_mock.return_value.chat_postMessage.reset_mock()
+        self.assertEqual(utils.notify('test_event', 'hello'), 2)
+        self.assertEqual(cmd.handle_tick(), 2)
+        # only the quiet channel gets it, noisy one still waiting for retry-after
+        self.sc_mock.return_value.chat_postMessage.assert_called_once()
+        self.assertEqual(models.Notification.objects.filter(target='#quiet', status=1).count(), 2)
+
+    def test_slack_channel_pacing(self):
+        self.sc_mock.return_value.chat_postMessage.return_value = {'ok': True}
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='#general')
+        for _ in range(3):
+            utils.notify('test_event', 'hello')
+        with override_settings(NOTIFICATIONS_SLACK_RATE_LIMITS={'channel': (1, 2)}):
+            cmd = notification_sender.Command()
+        cmd.handle_tick()
+        # burst of 2, third one waits for the next token
+        self.assertEqual(self.sc_mock.return_value.chat_postMessage.call_count, 2)
+        self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_PENDING).count(), 1)
+        self.assertIsNotNone(models.Notification.objects.get(status=models.Notification.STATUS_PENDING).claimed_until)
+
     def test_templated_email(self):
         e = models.Event.objects.create(
             name='test_event',
@@ -154,3 +402,535 @@ class SenderTest(TestCase):
             unfurl_links=0,
             username='NotTestBot',
         )
+
+    def test_claim_workers(self):
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@a\n@b')
+        self.assertEqual(utils.notify('test_event', 'hello'), 2)
+
+        cmd1 = notification_sender.Command()
+        cmd1.worker_id = 'worker1'
+        cmd2 = notification_sender.Command()
+        cmd2.worker_id = 'worker2'
+
+        # first worker takes everything, nothing left for the second one
+        claimed = cmd1.claim()
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(cmd2.claim(), [])
+        self.assertEqual(models.Notification.objects.filter(claimed_by='worker1').count(), 2)
+
+        # released rows can be claimed by others
+        cmd1.release(claimed[:1])
+        self.assertEqual([n.pk for n in cmd2.claim()], [claimed[0].pk])
+
+        # expired leases (crashed worker) are claimed again
+        models.Notification.objects.filter(claimed_by='worker1').update(
+            claimed_until=timezone.now() - datetime.timedelta(seconds=1)
+        )
+        self.assertEqual([n.pk for n in cmd2.claim()], [claimed[1].pk])
+        self.assertEqual(models.Notification.objects.filter(claimed_by='worker2').count(), 2)
+
+        # sent rows are never claimed
+        self.sc_mock.return_value.chat_postMessage.return_value = {'ok': True}
+        cmd2.handle_tick()
+        self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_SENT).count(), 0)
+        models.Notification.objects.update(claimed_until=None)
+        cmd2.handle_tick()
+        self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_SENT).count(), 2)
+        self.assertEqual(cmd1.claim(), [])
+
+    def test_batch_size(self):
+        self.sc_mock.return_value.chat_postMessage.return_value = {'ok': True}
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(
+            event=e, service=models.Subscription.Service.SLACK, target='\n'.join(f'@u{i}' for i in range(5))
+        )
+        utils.notify('test_event', 'hello')
+        cmd = notification_sender.Command()
+        cmd.batch_size = 2
+
+        self.assertEqual(cmd.handle_tick(), 2)
+        self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_SENT).count(), 2)
+        # rows created between batches are picked up as well
+        utils.notify('test_event', 'bye')
+        self.assertEqual(cmd.handle_tick(), 2)
+        self.assertEqual(cmd.handle_tick(), 2)
+        self.assertEqual(cmd.handle_tick(), 2)
+        self.assertEqual(cmd.handle_tick(), 2)
+        self.assertEqual(cmd.handle_tick(), 0)
+        self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_SENT).count(), 10)
+        self.assertEqual(self.sc_mock.return_value.chat_postMessage.call_count, 10)
+
+    def test_bulk_status_update(self):
+        self.sc_mock.return_value.chat_postMessage.return_value = {'ok': True}
+        e = models.Event.objects.create(name='test_event')
+        sub = models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@a')
+        cmd = notification_sender.Command()
+        for targets in (3, 9):
+            sub.target = '\n'.join(f'@u{i}' for i in range(targets))
+            sub.save()
+            utils.notify('test_event', 'hello')
+            # claim (savepoint, select per priority, update, fetch) and a single status UPDATE, regardless of batch size
+            with self.assertNumQueries(8):
+                self.assertEqual(cmd.handle_tick(), targets)
+        self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_SENT).count(), 12)
+
+    def test_bulk_status_update_interrupted(self):
+        self.sc_mock.return_value.chat_postMessage.return_value = {'ok': True}
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@a\n@b')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='a@mail.com')
+        utils.notify('test_event', 'hello')
+        cmd = notification_sender.Command()
+        with mock.patch.object(
+            cmd.backends[models.Subscription.Service.SLACK], 'send_batch', side_effect=KeyboardInterrupt
+        ):
+            with self.assertRaises(KeyboardInterrupt):
+                cmd.handle_tick()
+        # email was sent and that is recorded, slack ones were not
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(
+            list(models.Notification.objects.order_by('pk').values_list('status', flat=True)),
+            [models.Notification.STATUS_PENDING, models.Notification.STATUS_PENDING, models.Notification.STATUS_SENT],
+        )
+
+    def test_dequeue_fifo(self):
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@a\n@b\n@c')
+        utils.notify('test_event', 'hello')
+        a, b, c = models.Notification.objects.order_by('pk')
+        # b was created first
+        models.Notification.objects.filter(pk=b.pk).update(time=a.time - datetime.timedelta(seconds=1))
+        cmd = notification_sender.Command()
+        cmd.batch_size = 2
+        self.assertEqual([n.pk for n in cmd.claim()], [b.pk, a.pk])
+        self.assertEqual([n.pk for n in cmd.claim()], [c.pk])
+
+    @override_settings(NOTIFICATIONS_SENDER_POLL_MAX=10)
+    def test_dequeue_rows_behind_cursor(self):
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(
+            event=e, service=models.Subscription.Service.SLACK, target='\n'.join(f'@u{i}' for i in range(8))
+        )
+        utils.notify('test_event', 'hello')
+        n = list(models.Notification.objects.order_by('pk'))
+        cmd = notification_sender.Command()
+        cmd.batch_size = 2
+        self.assertEqual([c.pk for c in cmd.claim()], [n[0].pk, n[1].pk])
+        # released while the lane is still full: picked up again straight away
+        cmd.release([n[0]])
+        self.assertEqual([c.pk for c in cmd.claim()], [n[0].pk, n[2].pk])
+        self.assertEqual([c.pk for c in cmd.claim()], [n[3].pk, n[4].pk])
+        # left behind the cursor otherwise (claim expired, released with a delay): picked up once the lane starts over
+        models.Notification.objects.filter(pk=n[1].pk).update(claimed_until=timezone.now())
+        self.assertEqual([c.pk for c in cmd.claim()], [n[5].pk, n[6].pk])
+        with mock.patch('time.monotonic', return_value=time.monotonic() + 11):
+            self.assertEqual([c.pk for c in cmd.claim()], [n[1].pk, n[7].pk])
+
+    def test_dequeue_priority(self):
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@a')
+        utils.notify('test_event', 'low', priority=models.Priority.LOW)
+        utils.notify('test_event', 'normal')
+        utils.notify('test_event', 'high', priority=models.Priority.HIGH)
+        cmd = notification_sender.Command()
+        # higher priorities first, regardless of time
+        self.assertEqual([n.message_text for n in cmd.claim()], ['high', 'normal', 'low'])
+        self.assertFalse(cmd._more)
+
+    @override_settings(NOTIFICATIONS_SENDER_LANE_SHARE={'low': 0.5})
+    def test_dequeue_lane_share(self):
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@a\n@b\n@c')
+        utils.notify('test_event', 'low', priority=models.Priority.LOW)
+        cmd = notification_sender.Command()
+        cmd.batch_size = 4
+        # low priority notifications only get half of the batch, even with nothing else pending
+        self.assertEqual(len(cmd.claim()), 2)
+        self.assertTrue(cmd._more)
+        utils.notify('test_event', 'high', priority=models.Priority.HIGH)
+        self.assertEqual([n.message_text for n in cmd.claim()], ['high'] * 3 + ['low'])
+        self.assertEqual(cmd.claim(), [])
+        self.assertFalse(cmd._more)
+
+    def test_coalesce(self):
+        self.sc_mock.return_value.chat_postMessage.return_value = {'ok': True}
+        e = models.Event.objects.create(name='test_event', coalesce_window=60)
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@a\n@b')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='a@mail.com')
+        before = timezone.now()
+        utils.notify('test_event', 'hello 1', subject='alert')
+        utils.notify('test_event', 'hello 2', subject='alert')
+        utils.notify('test_event', blocks.Basic('hello 3'))
+        self.assertEqual(models.Notification.objects.count(), 9)
+        # held until the end of the window (the same for all of them)
+        (held_until,) = set(models.Notification.objects.values_list('next_attempt_at', flat=True))
+        self.assertGreater(held_until, before)
+        self.assertLessEqual(held_until, before + datetime.timedelta(seconds=60))
+        self.assertEqual(held_until.timestamp() % 60, 0)
+        call_command('notification_sender', run_once=True)
+        self.sc_mock.return_value.chat_postMessage.assert_not_called()
+
+        models.Notification.objects.update(next_attempt_at=before)
+        call_command('notification_sender', run_once=True)
+        self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_SENT).count(), 9)
+        # one message per target, with the blocks of all of them
+        self.assertEqual(self.sc_mock.return_value.chat_postMessage.call_count, 2)
+        for call in self.sc_mock.return_value.chat_postMessage.call_args_list:
+            self.assertEqual(call.kwargs['text'], 'alert: hello 1\nalert: hello 2\nhello 3')
+            self.assertEqual(
+                [b['type'] for b in call.kwargs['blocks']], ['section', 'divider', 'section', 'divider', 'section']
+            )
+        self.assertEqual(
+            sorted(call.kwargs['channel'] for call in self.sc_mock.return_value.chat_postMessage.call_args_list),
+            ['@a', '@b'],
+        )
+        # and a single email
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject, 'alert (+2)')
+        self.assertEqual(mail.outbox[0].body.split('\n\n' + '-' * 40 + '\n\n'), ['hello 1', 'hello 2', 'hello 3'])
+
+    def test_coalesce_slack_max_blocks(self):
+        self.sc_mock.return_value.chat_postMessage.return_value = {'ok': True}
+        e = models.Event.objects.create(name='test_event', coalesce_window=60)
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@a')
+        for i in range(30):
+            utils.notify('test_event', f'hello {i}')
+        models.Notification.objects.update(next_attempt_at=timezone.now())
+        call_command('notification_sender', run_once=True)
+        # 25 blocks and 24 dividers per message at most
+        calls = self.sc_mock.return_value.chat_postMessage.call_args_list
+        self.assertEqual([len(call.kwargs['blocks']) for call in calls], [49, 9])
+
+    def test_coalesce_failed(self):
+        self.sc_mock.return_value.chat_postMessage.side_effect = SlackApiError('none', {'error': 'channel_not_found'})
+        e = models.Event.objects.create(name='test_event', coalesce_window=60)
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.SLACK, target='@a')
+        utils.notify('test_event', 'hello 1')
+        utils.notify('test_event', 'hello 2')
+        models.Notification.objects.update(next_attempt_at=timezone.now())
+        call_command('notification_sender', run_once=True)
+        self.sc_mock.return_value.chat_postMessage.assert_called_once()
+        # all of them failed
+        self.assertEqual(
+            list(models.Notification.objects.values_list('status', 'attempts')),
+            [(models.Notification.STATUS_ERROR, 1)] * 2,
+        )
+
+    def test_mail_connection_reuse(self):
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='a@mail.com')
+        for i in range(3):
+            utils.notify('test_event', f'hello {i}')
+
+        with mock.patch('notifications.backends.get_connection', wraps=get_connection) as conn_mock:
+            call_command('notification_sender', run_once=True)
+            # one connection for the whole batch
+            conn_mock.assert_called_once_with()
+        self.assertEqual(len(mail.outbox), 3)
+
+        for i in range(3):
+            utils.notify('test_event', f'hello {i}')
+        with override_settings(NOTIFICATIONS_MAIL_CONNECTION_MAX_MESSAGES=2):
+            with mock.patch('notifications.backends.get_connection', wraps=get_connection) as conn_mock:
+                call_command('notification_sender', run_once=True)
+                # reconnected after 2 emails
+                self.assertEqual(conn_mock.call_count, 2)
+        self.assertEqual(len(mail.outbox), 6)
+
+
+class BulkBackend(backends.Backend):
+    """
+    backend for a service with a bulk API, recording its calls
+    """
+
+    calls = []
+
+    def rate_keys(self, notification):
+        return (('target', notification.target),)
+
+    def send_batch(self, notifications):
+        self.calls.append([n.target for n in notifications])
+        return [ValueError('bad target') if n.target == '@bad' else None for n in notifications]
+
+
+@override_settings(
+    NOTIFICATIONS_BACKENDS={
+        'S': {'BACKEND': 'tests.test_sender.BulkBackend', 'BATCH_SIZE': 2, 'RATE_LIMITS': {'target': (1, 1)}}
+    }
+)
+class BackendsTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        BulkBackend.calls = []
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(
+            event=e, service=models.Subscription.Service.SLACK, target='@a\n@b\n@bad\n@c\n@d'
+        )
+
+    def test_batches(self):
+        cmd = notification_sender.Command()
+        self.assertIsInstance(cmd.backends[models.Subscription.Service.SLACK], BulkBackend)
+        self.assertIsInstance(cmd.backends[models.Subscription.Service.MAIL], backends.MailBackend)
+        utils.notify('test_event', 'hello')
+        self.assertEqual(cmd.handle_tick(), 5)
+        self.assertEqual(BulkBackend.calls, [['@a', '@b'], ['@bad', '@c'], ['@d']])
+        self.assertEqual(
+            dict(models.Notification.objects.values_list('target', 'status')),
+            {
+                '@a': models.Notification.STATUS_SENT,
+                '@b': models.Notification.STATUS_SENT,
+                '@bad': models.Notification.STATUS_ERROR,
+                '@c': models.Notification.STATUS_SENT,
+                '@d': models.Notification.STATUS_SENT,
+            },
+        )
+
+        # rate limited per target, one per second
+        utils.notify('test_event', 'hello')
+        BulkBackend.calls = []
+        cmd.handle_tick()
+        self.assertEqual(BulkBackend.calls, [])
+        self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_PENDING).count(), 5)
+
+    @override_settings(NOTIFICATIONS_BACKENDS={'S': None})
+    def test_disabled(self):
+        cmd = notification_sender.Command()
+        self.assertNotIn(models.Subscription.Service.SLACK, cmd.backends)
+        utils.notify('test_event', 'hello')
+        cmd.handle_tick()
+        self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_ERROR).count(), 5)
+
+
+class SlackServerTest(TestCase):
+    """
+    Slack delivery against a local stand-in for the Slack API
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(
+            event=e, service=models.Subscription.Service.SLACK, target='\n'.join(f'#c{i}' for i in range(8))
+        )
+
+    def respond(self, path, data):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.05)
+        with self.lock:
+            self.in_flight -= 1
+        if data['channel'] == '#limited':
+            return 429, {'Retry-After': '1'}, {'ok': False, 'error': 'ratelimited'}
+        return 200, {}, {'ok': True, 'channel': data['channel']}
+
+    def _send(self, concurrency):
+        with http_server.LocalServer(self.respond) as server:
+            with override_settings(NOTIFICATIONS_SLACK_API_URL=server.url, NOTIFICATIONS_SLACK_APP_TOKEN='xoxb-test'):
+                cmd = notification_sender.Command()
+            cmd.backends[models.Subscription.Service.SLACK].concurrency = concurrency
+            cmd.handle_tick()
+        return server.requests
+
+    def test_concurrent(self):
+        utils.notify('test_event', 'hello')
+        requests = self._send(4)
+        # every channel posted exactly once, with concurrent calls
+        self.assertEqual(sorted(r[1]['channel'] for r in requests), sorted(f'#c{i}' for i in range(8)))
+        self.assertTrue(all(r[0] == '/chat.postMessage' for r in requests))
+        self.assertGreater(self.max_in_flight, 1)
+        self.assertLessEqual(self.max_in_flight, 4)
+        self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_SENT).count(), 8)
+
+    def test_sequential(self):
+        utils.notify('test_event', 'hello')
+        requests = self._send(1)
+        self.assertEqual(len(requests), 8)
+        self.assertEqual(self.max_in_flight, 1)
+        self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_SENT).count(), 8)
+
+    def test_concurrent_rate_limit(self):
+        models.Subscription.objects.update(target='#limited')
+        utils.notify('test_event', 'hello')
+        self.assertEqual(self._send(4), [('/chat.postMessage', mock.ANY)])
+        # rate limited, still pending
+        self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_PENDING).count(), 1)
+
+
+class WebhookServerTest(TestCase):
+    """
+    webhook delivery against a local HTTP consumer
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.e = models.Event.objects.create(name='test_event')
+
+    def respond(self, path, data):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.02)
+        with self.lock:
+            self.in_flight -= 1
+        if path == '/limited':
+            return 429, {'Retry-After': '30'}, {}
+        if path == '/broken':
+            return 500, {}, {}
+        return 200, {}, {'ok': True}
+
+    def _send(self, paths, message='hello', **settings):
+        with http_server.LocalServer(self.respond) as server:
+            models.Subscription.objects.create(
+                event=self.e,
+                service=models.Subscription.Service.WEBHOOK,
+                target='\n'.join(f'{server.url}{p}' for p in paths),
+            )
+            utils.notify('test_event', message)
+            with override_settings(**settings):
+                cmd = notification_sender.Command()
+            backend = cmd.backends[models.Subscription.Service.WEBHOOK]
+            try:
+                cmd.handle_tick()
+            finally:
+                backend.close()
+        return server.requests, backend
+
+    @override_settings(NOTIFICATIONS_WEBHOOK_MAX_PER_HOST=2)
+    def test_pool_per_host(self):
+        requests, backend = self._send([f'hook{i}' for i in range(12)], NOTIFICATIONS_WEBHOOK_CONCURRENCY=8)
+        self.assertEqual(sorted(r[0] for r in requests), sorted(f'/hook{i}' for i in range(12)))
+        self.assertEqual({r[1]['text'] for r in requests}, {'hello'})
+        self.assertEqual(models.Notification.objects.filter(status=models.Notification.STATUS_SENT).count(), 12)
+        # concurrent, but never more than 2 requests (nor connections) to the same host
+        self.assertEqual(self.max_in_flight, 2)
+        self.assertEqual(backend.pool.opened, 2)
+
+    def test_payload(self):
+        with http_server.LocalServer(self.respond) as server:
+            models.Subscription.objects.create(
+                event=self.e, service=models.Subscription.Service.WEBHOOK, target=f'{server.url}hook'
+            )
+            utils.notify('test_event', 'hello', subject='hi')
+            utils.notify('test_event', blocks.Message([blocks.Section('a'), blocks.BasicSubject('b', 'c')]))
+            cmd = notification_sender.Command()
+            cmd.handle_tick()
+            cmd.backends[models.Subscription.Service.WEBHOOK].close()
+        # posted concurrently, in any order
+        self.assertEqual(
+            sorted((data for _, data in server.requests), key=lambda data: data['text']),
+            [
+                {
+                    'event': 'test_event',
+                    'text': 'a\nb',
+                    'subject': 'c',
+                    'blocks': [{'type': 'section', 'text': {'type': 'mrkdwn', 'text': 'a'}}],
+                },
+                {'event': 'test_event', 'text': 'hello', 'subject': 'hi'},
+            ],
+        )
+
+    def test_errors(self):
+        requests, _ = self._send(['limited', 'broken', 'ok'])
+        self.assertEqual(len(requests), 3)
+        by_target = {n.target.rsplit('/', 1)[1]: n for n in models.Notification.objects.all()}
+        # rate limited: still pending, not counted as an attempt
+        self.assertEqual(by_target['limited'].status, models.Notification.STATUS_PENDING)
+        self.assertEqual(by_target['limited'].attempts, 0)
+        self.assertIsNotNone(by_target['limited'].claimed_until)
+        # server error: retried later
+        self.assertEqual(by_target['broken'].status, models.Notification.STATUS_PENDING)
+        self.assertEqual(by_target['broken'].attempts, 1)
+        self.assertEqual(by_target['broken'].last_error, 'HTTPError: HTTP 500')
+        self.assertEqual(by_target['ok'].status, models.Notification.STATUS_SENT)
+
+
+@override_settings(NOTIFICATIONS_MAIL_FROM='some@mail.com')
+class WakeupTest(TestCase):
+    def setUp(self):
+        super().setUp()
+        StopWakeup.calls = []
+
+    def test_poll_wakeup_backoff(self):
+        w = wakeup.get_wakeup()
+        self.assertIsInstance(w, wakeup.PollWakeup)
+        with mock.patch('time.sleep') as sleep_mock:
+            for busy in (False, False, False, False, False, True, False):
+                w.wait(busy=busy)
+        self.assertEqual([c.args[0] for c in sleep_mock.call_args_list], [2, 4, 8, 10, 10, 1, 2])
+
+    def test_postgres_wakeup_psycopg3(self):
+        conn = mock.Mock(spec=['fileno', 'notifies'])
+        w = wakeup.PostgresWakeup()
+        p = mock.patch('notifications.wakeup.logger')
+        logger_mock = p.start()
+        self.addCleanup(p.stop)
+        with mock.patch.object(w, '_listen', return_value=conn), mock.patch('select.select') as select_mock:
+            # nothing arrived before the timeout
+            select_mock.return_value = ([], [], [])
+            w.sleep(5)
+            conn.notifies.assert_not_called()
+            # notification received: the first one is read (notifies() without psycopg 3.2 only arguments)
+            select_mock.return_value = ([conn.fileno.return_value], [], [])
+            conn.notifies.return_value = mock.MagicMock()
+            w.sleep(5)
+        conn.notifies.assert_called_once_with()
+        conn.notifies.return_value.__next__.assert_called_once_with()
+        conn.notifies.return_value.close.assert_called_once_with()
+        self.assertEqual([c.args[3] for c in select_mock.call_args_list], [5, 5])
+
+        # received while the last tick ran (by the handler added by _listen): no wait at all
+        w._notified(mock.Mock())
+        with mock.patch.object(w, '_listen', return_value=conn), mock.patch('select.select') as select_mock:
+            w.sleep(5)
+            select_mock.assert_not_called()
+            # only once
+            select_mock.return_value = ([], [], [])
+            w.sleep(5)
+            select_mock.assert_called_once()
+        # no fallback to polling
+        logger_mock.exception.assert_not_called()
+
+    def test_postgres_wakeup_psycopg2(self):
+        conn = mock.Mock(spec=['poll', 'notifies'])
+        conn.notifies = []
+        w = wakeup.PostgresWakeup()
+        with mock.patch.object(w, '_listen', return_value=conn), mock.patch('select.select') as select_mock:
+            select_mock.return_value = ([], [], [])
+            w.sleep(5)
+            select_mock.assert_called_once_with([conn], [], [], 5)
+            # already received (by the queries of the last tick, or read by poll()): no wait at all
+            select_mock.reset_mock()
+            conn.notifies.append(mock.Mock())
+            w.sleep(5)
+            select_mock.assert_not_called()
+            self.assertEqual(conn.notifies, [])
+
+    @override_settings(NOTIFICATIONS_SENDER_WAKEUP='tests.test_sender.StopWakeup')
+    def test_handle_waits_when_idle(self):
+        e = models.Event.objects.create(name='test_event')
+        models.Subscription.objects.create(event=e, service=models.Subscription.Service.MAIL, target='a@mail.com')
+        utils.notify('test_event', 'hello')
+        with self.assertRaises(StopWakeup.Stop):
+            call_command('notification_sender')
+        # wait() called after processing the first (partial) batch
+        self.assertEqual(StopWakeup.calls, [True])
+        self.assertEqual(len(mail.outbox), 1)
+
+
+class StopWakeup(wakeup.PollWakeup):
+    class Stop(Exception):
+        pass
+
+    calls = []
+
+    def wait(self, busy):
+        self.calls.append(busy)
+        raise self.Stop()
@@ -14,6 +14,6 @@ class Test(TestCase):
         call_command('notification_test', 'test_event', 'Hello World!', stdout=out)
         self.assertEqual(models.Notification.objects.count(), 1)
         n = models.Notification.objects.first()
-        self.assertEqual(n.message, 'Hello World!')
+        self.assertEqual(n.message_text, 'Hello World!')
         self.assertEqual(n.status, models.Notification.STATUS_PENDING)
         self.assertEqual(out.getvalue().strip(), '1 notifications created')